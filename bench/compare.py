@@ -0,0 +1,45 @@
+"""
+Compare the median timings of two benchmark reports.
+
+    python -m bench.compare base.json new.json [--threshold 1.1]
+
+Exits with status 1 when a timing got slower than the threshold ratio.
+"""
+
+import argparse
+import json
+import sys
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("base")
+    parser.add_argument("new")
+    parser.add_argument("--threshold", type=float, default=1.1)
+    args = parser.parse_args()
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    print(f"base {base.get('commit')}  new {new.get('commit')}")
+
+    regressions = 0
+    for name, result in new["results"].items():
+        before = base["results"].get(name, {})
+        if "median" not in result or "median" not in before:
+            continue
+        ratio = result["median"] / before["median"]
+        mark = ""
+        if ratio > args.threshold:
+            mark = "  REGRESSION"
+            regressions += 1
+        print(
+            f"{name:60} {before['median'] * 1000:10.3f} ms "
+            f"{result['median'] * 1000:10.3f} ms {ratio:6.2f}x{mark}"
+        )
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+import hashlib
+import os
+import random
+
+import utils.job as jobs
+from utils import image as image_store
+
+IMAGE = "bench"
+
+# (state, exit code, weight) of generated jobs; "ready" jobs never ran.
+STATES = [("done", 0, 7), ("done", 1, 1), ("failed", -1, 1), ("ready", None, 1)]
+
+
+def generate(
+    count: int,
+    log_lines: int = 200,
+    artifact_size: int = 64 * 1024,
+    image_size: int = 1024 * 1024,
+    seed: int = 0,
+) -> list[int]:
+    """
+    Fill the job store with synthetic jobs with properties, scripts, logs and
+    artifacts, and return their IDs. Must run in the benchmark work directory.
+    """
+    rng = random.Random(seed)
+    tmp_path = image_store.tmp_path(IMAGE)
+    data = rng.randbytes(image_size)
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    image_store.commit(IMAGE, tmp_path, hashlib.sha256(data).hexdigest())
+
+    weights = [weight for _, _, weight in STATES]
+    ids = []
+    for i in range(count):
+        job_id = jobs.create_job()
+        jobs.update_job(
+            job_id,
+            jobs.ImageProperties(image=IMAGE, artifacts=["out.txt", "data.bin"]),
+        )
+        jobs.put_script(job_id, f"echo job {job_id}\n".encode())
+        state, exit_code, _ = rng.choices(STATES, weights)[0]
+        if state != "ready":
+            job_path = jobs.job_dir(job_id)
+            with open(f"{job_path}/{jobs.LOG_FILE}", "w") as f:
+                for line in range(log_lines):
+                    f.write(f"[{line:06d}] job {job_id} step {line} ok\n")
+            root = f"{job_path}/{jobs.ROOT_MOUNT}"
+            os.makedirs(root, exist_ok=True)
+            with open(f"{root}/out.txt", "w") as f:
+                f.write(f"result of job {job_id}\n" * (artifact_size // 32))
+            with open(f"{root}/data.bin", "wb") as f:
+                f.write(rng.randbytes(artifact_size))
+            jobs.set_exit_code(job_id, exit_code)
+            jobs.set_state(job_id, state)
+        ids.append(job_id)
+    return ids
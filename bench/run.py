@@ -0,0 +1,328 @@
+"""
+Benchmark the API hot paths against a generated job store.
+
+    python -m bench.run --jobs 2000 --output bench.json
+
+The store is generated in a temporary work directory (or --workdir), timed
+in-process and over HTTP against a local uvicorn running the local executor,
+and the results are written as JSON. Compare two runs with bench.compare.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from typing import Callable
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def stats(samples: list[float]) -> dict:
+    samples = sorted(samples)
+    return {
+        "count": len(samples),
+        "min": samples[0],
+        "median": statistics.median(samples),
+        "mean": statistics.fmean(samples),
+        "p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        "max": samples[-1],
+    }
+
+
+def measure(fn: Callable[[], object], repeat: int, warmup: int = 1) -> dict:
+    """
+    Get statistics of the run time of fn in seconds.
+    """
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return stats(samples)
+
+
+class Client:
+    """
+    Keep-alive HTTP client of the benchmarked server.
+    """
+
+    def __init__(self, port: int):
+        self.conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+
+    def request(
+        self, method: str, path: str, body: bytes | None = None, headers=None
+    ) -> tuple[int, bytes]:
+        self.conn.request(method, path, body=body, headers=headers or {})
+        response = self.conn.getresponse()
+        return response.status, response.read()
+
+    def get(self, path: str) -> bytes:
+        status, data = self.request("GET", path)
+        if status >= 400:
+            raise RuntimeError(f"GET {path} returned {status}")
+        return data
+
+    def close(self):
+        self.conn.close()
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(workdir: str, port: int) -> subprocess.Popen:
+    env = dict(os.environ, RES_EXECUTOR="local", PYTHONPATH=REPO_ROOT)
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app"]
+        + ["--port", str(port), "--log-level", "warning"],
+        cwd=workdir,
+        env=env,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            Client(port).get("/jobs/?limit=1")
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("Server did not start")
+
+
+def multipart(field: str, filename: str, data: bytes) -> tuple[bytes, dict]:
+    boundary = uuid.uuid4().hex
+    body = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+        "Content-Type: application/octet-stream\r\n\r\n"
+    ).encode()
+    body += data + f"\r\n--{boundary}--\r\n".encode()
+    return body, {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+
+
+def bench_in_process(ids: list[int], repeat: int) -> dict:
+    import utils.job as jobs
+
+    rng = random.Random(1)
+    results = {
+        "job_from_id": measure(lambda: jobs.job_from_id(rng.choice(ids)), repeat),
+    }
+    for limit in (10, 100, 1000):
+        results[f"get_jobs[limit={limit}]"] = measure(
+            lambda: jobs.get_jobs("", 0, limit), max(1, repeat // 10)
+        )
+    return results
+
+
+def bench_http(port: int, ids: list[int], repeat: int, upload_sizes: list[int]):
+    import utils.job as jobs
+
+    client = Client(port)
+    rng = random.Random(2)
+    finished = [i for i in ids if jobs.is_done(jobs.job_state(i))]
+    results = {}
+    for limit in (10, 100, 1000):
+        for state in ("", "done", "failed"):
+            results[f"GET /jobs/?limit={limit}&state={state}"] = measure(
+                lambda: client.get(f"/jobs/?limit={limit}&state={state}"),
+                max(1, repeat // 10),
+            )
+    results["GET /jobs/{id}/"] = measure(
+        lambda: client.get(f"/jobs/{rng.choice(ids)}/"), repeat
+    )
+    results["GET /jobs/{id}/artifacts/"] = measure(
+        lambda: client.get(f"/jobs/{rng.choice(finished)}/artifacts/"), repeat
+    )
+    for fmt in ("zip-deflate", "tar"):
+        results[f"GET /jobs/{{id}}/artifacts/data?format={fmt}"] = measure(
+            lambda: client.get(
+                f"/jobs/{rng.choice(finished)}/artifacts/data?format={fmt}"
+            ),
+            repeat,
+        )
+    results["GET /jobs/{id}/log/"] = measure(
+        lambda: client.get(f"/jobs/{rng.choice(finished)}/log/"), repeat
+    )
+    results["GET /jobs/{id}/log/?tail=10"] = measure(
+        lambda: client.get(f"/jobs/{rng.choice(finished)}/log/?tail=10"), repeat
+    )
+
+    for size in upload_sizes:
+        data = rng.randbytes(size)
+
+        def upload():
+            name = f"upload-{uuid.uuid4().hex[:8]}"
+            body, headers = multipart("file", f"{name}.sif", data)
+            status, _ = client.request("PUT", f"/images/{name}/raw", body, headers)
+            if status != 201:
+                raise RuntimeError(f"Image upload returned {status}")
+
+        result = measure(upload, max(1, repeat // 20))
+        result["bytes_per_second"] = size / result["median"]
+        results[f"PUT /images/{{name}}/raw[size={size}]"] = result
+    client.close()
+    return results
+
+
+def bench_throughput(
+    port: int, ids: list[int], clients: int, requests: int, jobs_per_client: int
+) -> dict:
+    """
+    Run concurrent clients reading jobs, then creating and running jobs with
+    the local executor, and get the request and job rates.
+    """
+
+    def run(worker: Callable[[Client, random.Random], None], count: int) -> dict:
+        latencies: list[float] = []
+        errors = []
+        lock = threading.Lock()
+
+        def loop(seed: int):
+            client = Client(port)
+            rng = random.Random(seed)
+            local = []
+            try:
+                for _ in range(count):
+                    start = time.perf_counter()
+                    worker(client, rng)
+                    local.append(time.perf_counter() - start)
+            except Exception as e:
+                errors.append(str(e))
+            finally:
+                client.close()
+                with lock:
+                    latencies.extend(local)
+
+        threads = [threading.Thread(target=loop, args=(i,)) for i in range(clients)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        result = stats(latencies) if latencies else {"count": 0}
+        result.update(
+            clients=clients,
+            seconds=elapsed,
+            requests_per_second=len(latencies) / elapsed,
+            errors=len(errors),
+        )
+        return result
+
+    def read(client: Client, rng: random.Random):
+        if rng.random() < 0.5:
+            client.get("/jobs/?limit=10")
+        else:
+            client.get(f"/jobs/{rng.choice(ids)}/")
+
+    results = {"read": run(read, requests)}
+
+    created: list[int] = []
+
+    def submit(client: Client, rng: random.Random):
+        status, data = client.request("POST", "/jobs/")
+        job_id = json.loads(data)["id"]
+        body = json.dumps({"image": "bench"}).encode()
+        headers = {"Content-Type": "application/json"}
+        client.request("PUT", f"/jobs/{job_id}/properties", body, headers)
+        body, headers = multipart("file", "script.sh", b"echo bench\n")
+        client.request("PUT", f"/jobs/{job_id}/script/", body, headers)
+        status, _ = client.request("PUT", f"/jobs/{job_id}/state/?state=start")
+        if status != 200:
+            raise RuntimeError(f"Job start returned {status}")
+        created.append(job_id)
+
+    start = time.perf_counter()
+    results["submit"] = run(submit, jobs_per_client)
+    client = Client(port)
+    for job_id in created:
+        while client.get(f"/jobs/{job_id}/state/").decode().strip('"') in (
+            "queued",
+            "running",
+        ):
+            time.sleep(0.01)
+    client.close()
+    elapsed = time.perf_counter() - start
+    results["submit"]["jobs_per_second"] = len(created) / elapsed
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=1000, help="Generated jobs")
+    parser.add_argument("--repeat", type=int, default=100, help="Samples per timing")
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200, help="Per client")
+    parser.add_argument("--submit", type=int, default=10, help="Jobs per client")
+    parser.add_argument(
+        "--upload-sizes",
+        type=lambda s: [int(x) for x in s.split(",")],
+        default=[1024**2, 16 * 1024**2, 64 * 1024**2],
+    )
+    parser.add_argument("--workdir", help="Work directory, temporary by default")
+    parser.add_argument("--output", default="-", help="JSON file, - for stdout")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="res-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    os.environ["RES_EXECUTOR"] = "local"
+    sys.path.insert(0, REPO_ROOT)
+    from bench.generate import generate
+
+    start = time.perf_counter()
+    ids = generate(args.jobs)
+    results = {"generate": {"jobs": len(ids), "seconds": time.perf_counter() - start}}
+    results.update(bench_in_process(ids, args.repeat))
+
+    port = free_port()
+    server = start_server(workdir, port)
+    try:
+        results.update(bench_http(port, ids, args.repeat, args.upload_sizes))
+        throughput = bench_throughput(
+            port, ids, args.clients, args.requests, args.submit
+        )
+        results.update({f"throughput[{k}]": v for k, v in throughput.items()})
+    finally:
+        server.terminate()
+        server.wait()
+
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    report = {
+        "commit": commit,
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "workdir": workdir,
+        "params": vars(args),
+        "results": results,
+    }
+    if args.output == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
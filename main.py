@@ -1,8 +1,26 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
-from routers import images, jobs, pipeline
+from routers import events, gc, images, jobs, metrics, overlays, pipeline
+from utils import pools, reaper, scheduler
+from utils.metrics import MetricsMiddleware
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await pools.store.run(scheduler.recover)
+    reaper.start()
+    yield
+    reaper.stop()
+
 
-app = FastAPI(title="Remote Script Executor API")
+app = FastAPI(title="Remote Script Executor API", lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
 
 app.include_router(images.router, prefix="/images", tags=["images"])
 app.include_router(jobs.router, prefix="/jobs", tags=["jobs"])
+app.include_router(overlays.router, prefix="/overlays", tags=["overlays"])
 app.include_router(pipeline.router, prefix="/pipelines", tags=["pipeline"])
+app.include_router(metrics.router, prefix="/metrics", tags=["metrics"])
+app.include_router(events.router, prefix="/events", tags=["events"])
+app.include_router(gc.router, prefix="/gc", tags=["gc"])
@@ -0,0 +1,47 @@
+from fastapi import APIRouter, Query, Request
+from fastapi.responses import StreamingResponse
+
+from utils import events, metrics
+
+router = APIRouter()
+
+KEEPALIVE_INTERVAL = 15
+
+
+@router.get("")
+async def get_events(
+    request: Request,
+    job: list[int] = Query([]),
+    pipeline: list[int] = Query([]),
+):
+    """
+    Stream job and pipeline state changes as server-sent events, only those of
+    the given jobs and pipelines when any are given. A Last-Event-ID header
+    resumes the stream after that event while it is still in the history.
+    """
+    last_event_id = request.headers.get("Last-Event-ID", "")
+
+    async def stream():
+        with events.Subscription(jobs=job, pipelines=pipeline) as subscription:
+            last = 0
+            if last_event_id.isdigit():
+                for event in events.history(int(last_event_id)):
+                    if subscription.wants(event):
+                        last = event["seq"]
+                        yield events.format_sse(event)
+            while True:
+                try:
+                    event = await subscription.get(KEEPALIVE_INTERVAL)
+                except TimeoutError:
+                    yield b": keepalive\n\n"
+                    continue
+                if event is None:
+                    return
+                if event["seq"] > last:
+                    yield events.format_sse(event)
+
+    return StreamingResponse(
+        metrics.count_bytes_async(stream(), "events"),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
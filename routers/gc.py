@@ -0,0 +1,47 @@
+from fastapi import APIRouter, HTTPException, Query
+
+from utils import reaper
+
+router = APIRouter()
+
+
+def policy(max_age: str | None, keep_last: int | None, quota: int | None):
+    """
+    Get the configured policy with the given values replaced.
+    """
+    overrides = {}
+    if max_age is not None:
+        try:
+            overrides["max_age"] = reaper.parse_max_age(max_age)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    if keep_last is not None:
+        overrides["keep_last"] = keep_last
+    if quota is not None:
+        overrides["quota"] = quota
+    return reaper.POLICY.model_copy(update=overrides)
+
+
+@router.get("", response_model=reaper.Report)
+async def plan_collection(
+    max_age: str | None = Query(None),
+    keep_last: int | None = Query(None, ge=0),
+    quota: int | None = Query(None, ge=0),
+):
+    """
+    List the jobs the reaper would delete and the bytes it would free, with
+    the configured policy or the policy given by the query parameters.
+    """
+    return await reaper.reap(policy(max_age, keep_last, quota), dry_run=True)
+
+
+@router.post("", response_model=reaper.Report)
+async def collect(
+    max_age: str | None = Query(None),
+    keep_last: int | None = Query(None, ge=0),
+    quota: int | None = Query(None, ge=0),
+):
+    """
+    Delete the jobs selected by the policy now and report the freed bytes.
+    """
+    return await reaper.reap(policy(max_age, keep_last, quota))
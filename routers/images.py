@@ -1,43 +1,31 @@
-from fastapi import APIRouter, HTTPException, Request, UploadFile, File, Query
+from fastapi import APIRouter, HTTPException, Request, Query
 from fastapi.responses import FileResponse, Response
 from fastapi.responses import JSONResponse
+from python_multipart.multipart import (
+    MultipartParseError,
+    MultipartParser,
+    parse_options_header,
+)
+from typing import AsyncIterator
+import asyncio
 import os
 import hashlib
 
-from utils.job import HASH_ATTR
+import utils.image as image_store
+from utils import metrics, pools
 
 router = APIRouter()
 
-IMAGE_STORE = ".store/images"
+IMAGE_STORE = image_store.IMAGES_STORE
 
 SUPPORTED_MEDIA_TYPES = ["application/json"]
+CHUNK_SIZE = 1024 * 1024
 
-if not os.path.exists(IMAGE_STORE):
-    os.makedirs(IMAGE_STORE)
 
-
-@router.put("/{name}/raw")
-async def upload_image(name: str, request: Request, file: UploadFile = File(...)):
+def check_etag(request_etag: str | None, current_etag: str | None):
     """
-    Upload a raw apptainer file.
+    Get the error response when the ETag precondition of an update fails.
     """
-    if file.filename is None:
-        raise HTTPException(status_code=400, detail="Filename is required")
-    if not file.filename.endswith(".sif"):
-        raise HTTPException(status_code=400, detail="File must be a .sif file")
-    if file.content_type != "application/octet-stream":
-        raise HTTPException(
-            status_code=400, detail="File must be of type application/octet-stream"
-        )
-
-    file_path = f"{IMAGE_STORE}/{name}.sif"
-    request_etag = request.headers.get("ETag")
-    current_etag = None
-    try:
-        current_etag = os.getxattr(file_path, HASH_ATTR).decode("utf-8")
-    except OSError:
-        pass
-
     if request_etag is None and current_etag is not None:
         return JSONResponse(
             status_code=428,
@@ -49,17 +37,163 @@ async def upload_image(name: str, request: Request, file: UploadFile = File(...)
             status_code=412,
             content={"detail": "Etag mismatch. The script has been modified."},
         )
+    return None
+
+
+async def iter_file_field(request: Request, field: str) -> AsyncIterator[bytes]:
+    """
+    Get the data of a file field of a multipart/form-data request as the body
+    is received, without spooling it. The file must be a .sif file of type
+    application/octet-stream.
+    """
+    content_type, params = parse_options_header(request.headers.get("Content-Type"))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise HTTPException(
+            status_code=400, detail="Request must be multipart/form-data"
+        )
+
+    headers: dict[bytes, bytes] = {}
+    header = [bytearray(), bytearray()]
+    part = {"file": False, "found": False, "end": False}
+    chunks: list[bytes] = []
+
+    def on_part_begin():
+        headers.clear()
+
+    def on_header_field(data: bytes, start: int, end: int):
+        header[0] += data[start:end]
+
+    def on_header_value(data: bytes, start: int, end: int):
+        header[1] += data[start:end]
+
+    def on_header_end():
+        headers[bytes(header[0]).lower()] = bytes(header[1])
+        header[0].clear()
+        header[1].clear()
+
+    def on_headers_finished():
+        _, disposition = parse_options_header(headers.get(b"content-disposition"))
+        part["file"] = disposition.get(b"name") == field.encode()
+        if not part["file"]:
+            return
+        part["found"] = True
+        filename = disposition.get(b"filename")
+        if filename is None:
+            raise HTTPException(status_code=400, detail="Filename is required")
+        if not filename.endswith(b".sif"):
+            raise HTTPException(status_code=400, detail="File must be a .sif file")
+        part_type, _ = parse_options_header(headers.get(b"content-type"))
+        if part_type != b"application/octet-stream":
+            raise HTTPException(
+                status_code=400,
+                detail="File must be of type application/octet-stream",
+            )
+
+    def on_part_data(data: bytes, start: int, end: int):
+        if part["file"]:
+            chunks.append(data[start:end])
+
+    def on_end():
+        part["end"] = True
+
+    parser = MultipartParser(
+        params[b"boundary"],
+        {
+            "on_end": on_end,
+            "on_part_begin": on_part_begin,
+            "on_header_field": on_header_field,
+            "on_header_value": on_header_value,
+            "on_header_end": on_header_end,
+            "on_headers_finished": on_headers_finished,
+            "on_part_data": on_part_data,
+        },
+    )
+    try:
+        async for body in request.stream():
+            parser.write(body)
+            if chunks:
+                yield b"".join(chunks)
+                chunks.clear()
+        parser.finalize()
+    except MultipartParseError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid multipart body: {e}")
+    if not part["end"]:
+        raise HTTPException(status_code=400, detail="Incomplete multipart body")
+    if not part["found"]:
+        raise HTTPException(status_code=400, detail=f"Field '{field}' is required")
 
-    with open(file_path, "wb") as f:
-        content = await file.read()
-        hash = hashlib.sha256(content).hexdigest()
+
+@router.put(
+    "/{name}/raw",
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "multipart/form-data": {
+                    "schema": {
+                        "type": "object",
+                        "required": ["file"],
+                        "properties": {"file": {"type": "string", "format": "binary"}},
+                    }
+                }
+            },
+        }
+    },
+)
+async def upload_image(name: str, request: Request):
+    """
+    Upload a raw apptainer file in the file field of a multipart form. The
+    file is streamed from the request body to a temporary file and stored as
+    a content-addressed blob once it is complete and hashed.
+    """
+    try:
+        image_store.check_name(name)
+    except image_store.ImageException as e:
+        raise HTTPException(status_code=400, detail=e.message)
+
+    file_path = f"{IMAGE_STORE}/{name}.sif"
+    request_etag = request.headers.get("ETag")
+    error = check_etag(
+        request_etag, await pools.store.run(image_store.get_digest, file_path)
+    )
+    if error is not None:
+        return error
+
+    tmp_path = image_store.tmp_path(name)
+    try:
+        hash = hashlib.sha256()
+        size = 0
+        with metrics.span("receive"):
+            f = await pools.store.run(open, tmp_path, "wb")
+            try:
+                async for chunk in iter_file_field(request, "file"):
+                    await asyncio.gather(
+                        pools.store.run(f.write, chunk),
+                        pools.cpu.run(hash.update, chunk),
+                    )
+                    size += len(chunk)
+            finally:
+                await pools.store.run(f.close)
+        metrics.bytes_streamed.inc(size, kind="image_upload")
+        if size == 0:
+            raise HTTPException(status_code=400, detail="File is empty")
+
+        error = check_etag(
+            request_etag, await pools.store.run(image_store.get_digest, file_path)
+        )
+        if error is not None:
+            return error
         try:
-            os.setxattr(file_path, HASH_ATTR, hash.encode("utf-8"))
+            with metrics.span("commit"):
+                await pools.store.run(
+                    image_store.commit, name, tmp_path, hash.hexdigest()
+                )
         except OSError as e:
-            raise HTTPException(status_code=500, detail=f"Error setting ETag: {str(e)}")
-        f.write(content)
-    if not content:
-        raise HTTPException(status_code=400, detail="File is empty")
+            raise HTTPException(
+                status_code=500, detail=f"Error storing image: {str(e)}"
+            )
+    finally:
+        await pools.store.run(image_store.discard_tmp, tmp_path)
 
     return Response(status_code=201, headers={"Location": f"/images/{name}/properties"})
 
@@ -69,30 +203,177 @@ async def get_image_raw(name: str):
     """
     Get a raw apptainer image file (.sif).
     """
-    file_path = os.path.join(IMAGE_STORE, f"{name}.sif")
-    if not os.path.exists(file_path):
+    entry = image_store.catalog_get(name)
+    if entry is None:
         raise HTTPException(status_code=404, detail=f"Image '{name}' not found")
 
+    file_path = image_store.tag_path(name)
+    metrics.bytes_streamed.inc(entry["size"], kind="image_download")
     return FileResponse(
         path=file_path, media_type="application/octet-stream", filename=f"{name}.sif"
     )
 
 
+def upload_headers(name: str, upload_id: str, offset: int) -> dict[str, str]:
+    headers = {
+        "Location": f"/images/{name}/uploads/{upload_id}",
+        "Upload-Offset": str(offset),
+    }
+    if offset > 0:
+        headers["Range"] = f"0-{offset - 1}"
+    return headers
+
+
+def parse_content_range(content_range: str) -> int | None:
+    """
+    Get the start of a "<start>-<end>" or "bytes <start>-<end>/<size>" range.
+    """
+    spec = content_range.strip().removeprefix("bytes").strip()
+    try:
+        return int(spec.split("-", 1)[0])
+    except ValueError:
+        return None
+
+
+@router.post("/{name}/uploads/")
+def start_upload(name: str):
+    """
+    Start a resumable upload of a raw apptainer file.
+    """
+    try:
+        image_store.check_name(name)
+    except image_store.ImageException as e:
+        raise HTTPException(status_code=400, detail=e.message)
+    upload_id = image_store.create_upload(name)
+    return JSONResponse(
+        status_code=202,
+        content={"id": upload_id},
+        headers=upload_headers(name, upload_id, 0),
+    )
+
+
+@router.get("/{name}/uploads/{upload_id}")
+def get_upload(name: str, upload_id: str):
+    """
+    Get the number of bytes committed to an upload.
+    """
+    try:
+        offset = image_store.upload_offset(upload_id, name)
+    except image_store.ImageException as e:
+        raise HTTPException(status_code=404, detail=e.message)
+    return Response(status_code=204, headers=upload_headers(name, upload_id, offset))
+
+
+@router.patch("/{name}/uploads/{upload_id}")
+async def patch_upload(name: str, upload_id: str, request: Request):
+    """
+    Append a chunk of the image to an upload. The chunk is the request body and
+    an optional Content-Range header must start at the committed offset.
+    """
+    async with image_store.upload_lock(upload_id):
+        return await append_chunk(name, upload_id, request)
+
+
+async def append_chunk(name: str, upload_id: str, request: Request) -> Response:
+    try:
+        offset = await pools.store.run(image_store.upload_offset, upload_id, name)
+    except image_store.ImageException as e:
+        raise HTTPException(status_code=404, detail=e.message)
+
+    content_range = request.headers.get("Content-Range")
+    start = offset if content_range is None else parse_content_range(content_range)
+    if start != offset:
+        return JSONResponse(
+            status_code=416,
+            headers=upload_headers(name, upload_id, offset),
+            content={"detail": "Range does not start at the upload offset"},
+        )
+
+    try:
+        offset = await image_store.append_upload(
+            upload_id,
+            name,
+            start,
+            metrics.count_bytes_async(request.stream(), "image_upload"),
+        )
+    except image_store.ImageException as e:
+        offset = await pools.store.run(image_store.upload_offset, upload_id, name)
+        return JSONResponse(
+            status_code=416,
+            headers=upload_headers(name, upload_id, offset),
+            content={"detail": e.message},
+        )
+    return Response(status_code=202, headers=upload_headers(name, upload_id, offset))
+
+
+@router.put("/{name}/uploads/{upload_id}")
+async def finish_upload(name: str, upload_id: str, request: Request, digest: str):
+    """
+    Finish an upload. The digest query parameter (sha256:<hex>) must match the
+    uploaded data. A request body is appended as the last chunk.
+    """
+    async with image_store.upload_lock(upload_id):
+        return await commit_upload(name, upload_id, request, digest)
+
+
+async def commit_upload(
+    name: str, upload_id: str, request: Request, digest: str
+) -> Response:
+    try:
+        offset = await pools.store.run(image_store.upload_offset, upload_id, name)
+    except image_store.ImageException as e:
+        raise HTTPException(status_code=404, detail=e.message)
+
+    file_path = f"{IMAGE_STORE}/{name}.sif"
+    request_etag = request.headers.get("ETag")
+    error = check_etag(
+        request_etag, await pools.store.run(image_store.get_digest, file_path)
+    )
+    if error is not None:
+        return error
+
+    try:
+        await image_store.append_upload(
+            upload_id,
+            name,
+            offset,
+            metrics.count_bytes_async(request.stream(), "image_upload"),
+        )
+        digest = await pools.cpu.run(image_store.finish_upload, name, upload_id, digest)
+    except image_store.ImageException as e:
+        raise HTTPException(status_code=400, detail=e.message)
+    return Response(
+        status_code=201,
+        headers={"Location": f"/images/{name}/properties", "ETag": digest},
+    )
+
+
+@router.delete("/{name}/uploads/{upload_id}")
+async def cancel_upload(name: str, upload_id: str):
+    """
+    Cancel an upload.
+    """
+    try:
+        async with image_store.upload_lock(upload_id):
+            await pools.store.run(image_store.cancel_upload, upload_id, name)
+    except image_store.ImageException as e:
+        raise HTTPException(status_code=404, detail=e.message)
+    return Response(status_code=204)
+
+
 @router.get("/{name}/properties")
 def get_image_properties(name: str):
     """
-    Get properties of an image.
+    Get properties of an image, with the metadata read from its SIF header.
     """
-    file_path = os.path.join(IMAGE_STORE, f"{name}.sif")
-    print(file_path)
-    if not os.path.exists(file_path):
+    entry = image_store.catalog_get(name)
+    if entry is None:
         raise HTTPException(status_code=404, detail=f"Image '{name}' not found")
 
+    digest = entry["digest"]
     return {
-        "name": name,
-        "size": os.path.getsize(file_path),
-        "type": "apptainer",
-        "status": "available",
+        **entry,
+        "references": image_store.references(digest) if digest else 1,
     }
 
 
@@ -109,32 +390,31 @@ async def delete_image(name: str):
     """
     Delete an image by name.
     """
-    file_path = os.path.join(IMAGE_STORE, f"{name}.sif")
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail=f"Image '{name}' not found")
-
-    os.remove(file_path)
+    try:
+        await pools.store.run(image_store.delete, name)
+    except image_store.ImageException as e:
+        raise HTTPException(status_code=404, detail=e.message)
     return Response(status_code=204)
 
 
 @router.get("/")
-def list_images(skip: int = Query(0, ge=0), limit: int = Query(10, gt=0)):
-    """
-    List all images in the store, with pagination support.
-    """
-    images = []
-    for filename in sorted(os.listdir(IMAGE_STORE)):
-        if filename.endswith(".sif"):
-            name = filename[:-4]
-            file_path = os.path.join(IMAGE_STORE, filename)
-            images.append(
-                {
-                    "name": name,
-                    "size": os.path.getsize(file_path),
-                    "type": "apptainer",
-                    "status": "available",
-                }
-            )
+def list_images(
+    request: Request, skip: int = Query(0, ge=0), limit: int = Query(10, gt=0)
+):
+    """
+    List all images in the store, with pagination support. The ETag changes
+    whenever an image is uploaded or deleted.
+    """
+    total, entries, etag = image_store.catalog_page(skip, limit)
+    if_none_match = request.headers.get("If-None-Match", "")
+    if etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers={"ETag": etag})
 
-    paginated = images[skip : skip + limit]
-    return {"total": len(images), "skip": skip, "limit": limit, "items": paginated}
+    paginated = [
+        {key: value for key, value in entry.items() if key != "sif"}
+        for entry in entries
+    ]
+    return JSONResponse(
+        content={"total": total, "skip": skip, "limit": limit, "items": paginated},
+        headers={"ETag": etag},
+    )
@@ -1,12 +1,22 @@
 import logging
-import asyncio
+import os
 
 from fastapi import APIRouter, UploadFile, File, Query, Request
-from fastapi.responses import JSONResponse, PlainTextResponse
+from fastapi.responses import (
+    FileResponse,
+    JSONResponse,
+    PlainTextResponse,
+    Response,
+    StreamingResponse,
+)
 import utils.job as utils
+from utils import archive, events, index, metrics, pools
+from utils.scheduler import scheduler
 
 logger = logging.getLogger("uvicorn.error")
 
+MAX_WAIT_TIMEOUT = 300
+
 router = APIRouter()
 
 
@@ -15,7 +25,7 @@ async def create_job():
     """
     Create a new job with the provided job data.
     """
-    max_job_id = utils.create_job()
+    max_job_id = await pools.store.run(utils.create_job)
     return JSONResponse(
         status_code=201,
         content={
@@ -25,6 +35,19 @@ async def create_job():
     )
 
 
+@router.post("/batch")
+async def create_jobs(count: int = Query(..., gt=0, le=utils.MAX_BATCH_SIZE)):
+    """
+    Create count jobs with consecutive IDs in one call.
+    """
+    ids = await pools.store.run(utils.create_jobs, count)
+    return JSONResponse(
+        status_code=201,
+        content={"ids": ids},
+        headers={"Location": f"/jobs/{ids[0]}"},
+    )
+
+
 @router.put("/{job_id}/properties", response_model=utils.Image)
 async def update_job(job_id: int, props: utils.ImageProperties):
     """
@@ -32,7 +55,7 @@ async def update_job(job_id: int, props: utils.ImageProperties):
     """
     job = None
     try:
-        job = utils.update_job(job_id, props)
+        job = await pools.store.run(utils.update_job, job_id, props)
     except utils.JobException as e:
         return JSONResponse(status_code=404, content={"detail": str(e)})
 
@@ -51,9 +74,10 @@ async def get_job(job_id: int):
     """
     Get job properties by job ID.
     """
-    job = utils.job_from_id(job_id)
+    job = await pools.store.run(utils.job_from_id, job_id)
     if job is None:
         return JSONResponse(status_code=404, content={"detail": "Job not found"})
+    job.queue_position = scheduler.position(job_id)
 
     return JSONResponse(
         status_code=200,
@@ -70,7 +94,7 @@ async def update_job_script(
     Update the script of a job.
     """
     request_etag = request.headers.get("Etag")
-    script_etag = utils.get_script_etag(job_id)
+    script_etag = await pools.store.run(utils.get_script_etag, job_id)
     if request_etag is None and script_etag is not None:
         return JSONResponse(
             status_code=428,
@@ -87,7 +111,7 @@ async def update_job_script(
     job = None
     hash = None
     try:
-        job, hash = utils.put_script(job_id, content)
+        job, hash = await pools.store.run(utils.put_script, job_id, content)
     except utils.JobException as e:
         return JSONResponse(status_code=404, content={"detail": str(e)})
 
@@ -107,7 +131,7 @@ async def get_job_script(job_id: int):
     """
     content = ""
     try:
-        content = utils.get_script(job_id)
+        content = await pools.store.run(utils.get_script, job_id)
     except utils.JobException as e:
         return JSONResponse(status_code=404, content={"detail": str(e)})
     return PlainTextResponse(
@@ -118,20 +142,27 @@ async def get_job_script(job_id: int):
 
 
 @router.get("/{job_id}/state/", response_model=str)
-def get_state(job_id: int):
+async def get_state(job_id: int):
     """
     Get the state of a job.
     """
-    state = utils.job_state(job_id)
-    return PlainTextResponse(
-        status_code=200, content=state, headers={"Location": f"/jobs/{job_id}/state/"}
-    )
+    state = await pools.store.run(utils.job_state, job_id)
+    headers = {
+        "Location": f"/jobs/{job_id}/state/",
+        "X-Queue-Depth": str(scheduler.depth),
+    }
+    position = scheduler.position(job_id)
+    if position is not None:
+        headers["X-Queue-Position"] = str(position)
+    return PlainTextResponse(status_code=200, content=state, headers=headers)
 
 
 @router.put("/{job_id}/state/", response_model=str)
 async def put_state(job_id: int, state: str):
     """
-    Set the state of a job. Available states to set are: "start", "stop"
+    Set the state of a job. Available states to set are: "start", "stop".
+    Started jobs are queued and run when the scheduler has a free slot.
+    Stopping a running job kills its process.
     """
     avalible_states = ["start", "stop"]
     if state not in avalible_states:
@@ -139,54 +170,147 @@ async def put_state(job_id: int, state: str):
             status_code=400,
             content={"detail": f"State must be one of {avalible_states}"},
         )
-    current_state = utils.job_state(job_id)
+    current_state = await pools.store.run(utils.job_state, job_id)
     if current_state == "not ready":
         return JSONResponse(
             status_code=400, content={"detail": "Job is not ready to be started"}
         )
 
-    try:
-        utils.set_state(job_id, state)
-    except utils.JobException as e:
-        return JSONResponse(status_code=404, content={"detail": str(e)})
-
     if state == "start":
         try:
-            asyncio.create_task(utils.launch_and_wait(job_id))
-        except utils.LaunchException as e:
-            return JSONResponse(status_code=500, content={"detail": str(e)})
+            await scheduler.submit(job_id)
+        except utils.JobException as e:
+            return JSONResponse(status_code=409, content={"detail": str(e)})
+    else:
+        await scheduler.stop(job_id)
+        try:
+            await pools.store.run(utils.set_state, job_id, "stopped")
+        except utils.JobException as e:
+            return JSONResponse(status_code=404, content={"detail": str(e)})
 
     return PlainTextResponse(
         status_code=200, content=state, headers={"Location": f"/jobs/{job_id}/state/"}
     )
 
 
+@router.get("/{job_id}/wait", response_model=str)
+async def wait_job(
+    job_id: int,
+    timeout: float = Query(30, ge=0, le=MAX_WAIT_TIMEOUT),
+    state: str | None = Query(None),
+):
+    """
+    Wait until the state of a job changes or the job is finished, for at most
+    timeout seconds, and get its state. state is the state last seen by the
+    client: when the job is in another state the call returns at once.
+    """
+    with events.Subscription(jobs=[job_id]) as subscription:
+        if not await pools.store.run(utils.job_exists, job_id):
+            return JSONResponse(status_code=404, content={"detail": "Job not found"})
+        current = await pools.store.run(utils.job_state, job_id)
+        waiting = current not in utils.TERMINAL_STATES and state in (None, current)
+        if waiting:
+            try:
+                event = await subscription.get(timeout)
+            except TimeoutError:
+                event = None
+            if event is not None:
+                current = event["state"]
+            else:
+                current = await pools.store.run(utils.job_state, job_id)
+    return PlainTextResponse(
+        status_code=200, content=current, headers={"Location": f"/jobs/{job_id}/state/"}
+    )
+
+
+def parse_range(range_header: str, size: int) -> tuple[int, int] | None:
+    """
+    Parse a single "bytes=" range into a (start, end) pair, end exclusive.
+    """
+    unit, _, spec = range_header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if first == "":
+            start, end = max(size - int(last), 0), size
+        else:
+            start = int(first)
+            end = size if last == "" else min(int(last) + 1, size)
+    except ValueError:
+        return None
+    if start >= end:
+        return None
+    return start, end
+
+
 @router.get("/{job_id}/log/", response_model=str)
-def get_logs(job_id: int):
+async def get_logs(
+    job_id: int,
+    request: Request,
+    offset: int = Query(0, ge=0),
+    tail: int | None = Query(None, gt=0),
+    follow: bool = Query(False),
+):
     """
-    Get job logs
+    Get job logs. offset skips the first bytes, tail returns only the last
+    lines and follow keeps streaming new output until the job finishes.
+    A Range header selects a byte range of the log.
     """
-    log_content = ""
     try:
-        log_content = utils.get_log(job_id)
+        size = await pools.store.run(utils.log_size, job_id)
     except utils.JobException as e:
-        return JSONResponse(status_code=404, content={"detail": str(e)})
+        current = await pools.store.run(utils.job_state, job_id)
+        if not follow or current not in utils.ACTIVE_STATES:
+            return JSONResponse(status_code=404, content={"detail": str(e)})
+        size = 0
+
+    await pools.store.run(index.job_accessed, job_id)
+    start, end = min(offset, size), size
+    if tail is not None and size > 0:
+        start = max(start, await pools.store.run(utils.log_tail_offset, job_id, tail))
+    status_code = 200
+    headers = {"Location": f"/jobs/{job_id}/log/", "Accept-Ranges": "bytes"}
+
+    if follow:
+        return StreamingResponse(
+            metrics.count_bytes_async(utils.follow_log(job_id, start), "log"),
+            media_type="text/plain",
+            headers=headers,
+        )
 
-    return PlainTextResponse(
-        status_code=200,
-        content=log_content,
-        headers={"Location": f"/jobs/{job_id}/log/"},
+    range_header = request.headers.get("Range")
+    if range_header:
+        byte_range = parse_range(range_header, size)
+        if byte_range is None:
+            return Response(
+                status_code=416, headers={"Content-Range": f"bytes */{size}"}
+            )
+        start, end = byte_range
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+
+    headers["Content-Length"] = str(end - start)
+    headers["X-Log-Offset"] = str(end)
+    return StreamingResponse(
+        metrics.count_bytes_async(
+            pools.store.iterate(utils.iter_log(job_id, start, end)), "log"
+        ),
+        status_code=status_code,
+        media_type="text/plain",
+        headers=headers,
     )
 
 
 @router.get("/{job_id}/artifacts/", response_model=list[utils.FileProperties])
-def get_artifacts(job_id: int):
+async def get_artifacts(job_id: int):
     """
     Get job artifacts
     """
     artifacts = []
     try:
-        artifacts = utils.get_artifacts(job_id)
+        with metrics.span("artifacts"):
+            artifacts = await pools.cpu.run(utils.get_artifacts, job_id)
     except utils.JobException as e:
         return JSONResponse(status_code=404, content={"detail": str(e)})
 
@@ -194,39 +318,69 @@ def get_artifacts(job_id: int):
 
 
 @router.get("/{job_id}/artifacts/data")
-def get_artifact_data(job_id: int):
+async def get_artifact_data(
+    job_id: int, request: Request, format: str | None = Query(None)
+):
     """
-    Get archive of artifacts
+    Get archive of artifacts. The archive format (zip-deflate, zip-stored, tar,
+    tar.zst) is selected by the format query parameter or the Accept header.
+    Archives of finished jobs are built once and served from the cache.
     """
     try:
-        artifacts = utils.get_artifacts_raw(job_id)
+        fmt = archive.negotiate(format, request.headers.get("Accept"))
+    except archive.ArchiveException as e:
+        status_code = 400 if format else 406
+        return JSONResponse(status_code=status_code, content={"detail": str(e)})
+    filename = f"artifacts_{job_id}.{archive.extension(fmt)}"
+    await pools.store.run(index.job_accessed, job_id)
+    if utils.is_done(await pools.store.run(utils.job_state, job_id)):
+        if_none_match = request.headers.get("If-None-Match", "")
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        try:
+            # The key comes from the manifest, so a matching client is
+            # answered without building or even opening the archive.
+            key = await pools.store.run(utils.artifacts_key, job_id, fmt)
+            if f'"{key}"' in tags:
+                return Response(status_code=304, headers={"ETag": f'"{key}"'})
+            path, key = await pools.cpu.run(utils.artifacts_archive, job_id, fmt)
+        except utils.JobException as e:
+            return JSONResponse(status_code=404, content={"detail": str(e)})
+        etag = f'"{key}"'
+        metrics.bytes_streamed.inc(os.path.getsize(path), kind="artifacts")
+        return FileResponse(
+            path,
+            media_type=archive.media_type(fmt),
+            filename=filename,
+            headers={"ETag": etag},
+        )
+
+    try:
+        files = await pools.store.run(utils.artifact_files, job_id)
     except utils.JobException as e:
         return JSONResponse(status_code=404, content={"detail": str(e)})
-    return PlainTextResponse(
+    return StreamingResponse(
+        metrics.count_bytes_async(
+            pools.cpu.iterate(archive.iter_archive(files, fmt)), "artifacts"
+        ),
         status_code=200,
-        content=artifacts.getvalue(),
-        headers={
-            "Content-Disposition": f'attachment; filename="artifacts_{job_id}.zip"',
-            "Content-Type": "application/zip",
-        },
+        media_type=archive.media_type(fmt),
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
     )
 
 
 @router.get("/")
-def list_jobs(
+async def list_jobs(
     skip: int = Query(0, ge=0), limit: int = Query(10, gt=0), state: str = Query("")
 ):
     """
     List all images in the store, with pagination support.
     """
-    jobs = utils.get_jobs(state)
-    if not jobs:
-        return {"total": 0, "skip": skip, "limit": limit, "items": []}
-    total = len(jobs)
-    paginated = jobs[skip : skip + limit]
+    total, jobs = await pools.store.run(utils.get_jobs, state, skip, limit)
+    for job in jobs:
+        job.queue_position = scheduler.position(job.id)
     return {
         "total": total,
         "skip": skip,
         "limit": limit,
-        "items": [job.model_dump() for job in paginated],
+        "items": [job.model_dump() for job in jobs],
     }
@@ -0,0 +1,53 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+import utils.job as jobs
+from utils import build_cache, image as image_store, index, metrics, overlay
+from utils.scheduler import scheduler
+
+router = APIRouter()
+
+STORE_AREAS = {
+    "jobs": jobs.JOBS_STORE,
+    "images": image_store.IMAGES_STORE,
+    "build_cache": build_cache.BUILD_CACHE_STORE,
+    "overlays": overlay.OVERLAYS_STORE,
+}
+
+_disk_usage = metrics.CachedValue(
+    lambda: {(area,): metrics.disk_usage(path) for area, path in STORE_AREAS.items()},
+    metrics.DISK_USAGE_INTERVAL,
+)
+
+metrics.Gauge(
+    "res_queue_depth",
+    "Jobs waiting in the scheduler queue",
+    callback=lambda: {(): scheduler.depth},
+)
+metrics.Gauge(
+    "res_running_jobs",
+    "Jobs running in containers",
+    callback=lambda: {(): len(scheduler.running)},
+)
+metrics.Gauge(
+    "res_jobs",
+    "Jobs in the store by state",
+    ("state",),
+    callback=lambda: {(state,): count for state, count in index.count_jobs().items()},
+)
+metrics.Gauge(
+    "res_store_disk_bytes",
+    "Disk usage of the store by area, refreshed every RES_METRICS_DISK_INTERVAL s",
+    ("area",),
+    callback=_disk_usage.get,
+)
+
+
+@router.get("", response_class=PlainTextResponse)
+def get_metrics():
+    """
+    Get the service metrics in the Prometheus text format.
+    """
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
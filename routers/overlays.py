@@ -0,0 +1,91 @@
+import os
+
+from fastapi import APIRouter
+from fastapi.responses import FileResponse, JSONResponse, Response
+
+from utils import executor, overlay, pools
+
+router = APIRouter()
+
+
+@router.get("/", response_model=list[overlay.OverlayTemplate])
+def list_overlays():
+    """
+    Retrieve all overlay templates.
+    """
+    return overlay.list_templates()
+
+
+@router.put("/{name}", response_model=overlay.OverlayTemplate)
+async def put_overlay(name: str, definition: overlay.OverlayDefinition):
+    """
+    Define an overlay template and build it by running the setup script in the
+    image. Nothing is rebuilt when the image and the script did not change.
+    Templates are built and used by the apptainer executor only.
+    """
+    if executor.EXECUTOR != executor.ApptainerExecutor.name:
+        return JSONResponse(
+            status_code=400,
+            content={"detail": "Overlay templates need the apptainer executor"},
+        )
+    async with overlay.define_lock:
+        try:
+            changed = await pools.store.run(overlay.define, name, definition)
+        except overlay.OverlayException as e:
+            return JSONResponse(status_code=400, content={"detail": e.message})
+        if changed:
+            overlay.start_build(name)
+    template = await pools.store.run(overlay.get_template, name)
+    return JSONResponse(
+        status_code=202 if changed else 200,
+        content=template.model_dump(),
+        headers={"Location": f"/overlays/{name}"},
+    )
+
+
+@router.get("/{name}", response_model=overlay.OverlayTemplate)
+def get_overlay(name: str):
+    """
+    Get the image, setup script and build state of an overlay template.
+    """
+    try:
+        template = overlay.get_template(name)
+    except overlay.OverlayException as e:
+        return JSONResponse(status_code=400, content={"detail": e.message})
+    if template is None:
+        return JSONResponse(
+            status_code=404, content={"detail": "Overlay template not found"}
+        )
+    return template
+
+
+@router.get("/{name}/log")
+def get_overlay_log(name: str):
+    """
+    Get the output of the last build of an overlay template.
+    """
+    try:
+        log_path = f"{overlay.template_path(name)}/{overlay.LOG_FILE}"
+    except overlay.OverlayException as e:
+        return JSONResponse(status_code=400, content={"detail": e.message})
+    if not os.path.exists(log_path):
+        return JSONResponse(status_code=404, content={"detail": "Log file not found"})
+    return FileResponse(log_path, media_type="text/plain")
+
+
+@router.delete("/{name}")
+async def delete_overlay(name: str):
+    """
+    Delete an overlay template. Jobs keep their own snapshots of it.
+    """
+    try:
+        async with overlay.define_lock:
+            await pools.store.run(overlay.delete, name)
+    except overlay.OverlayException as e:
+        status_code = 400
+        if e.message == "Overlay template not found":
+            status_code = 404
+        elif e.message == "Overlay template is being built":
+            status_code = 409
+        return JSONResponse(status_code=status_code, content={"detail": e.message})
+    return Response(status_code=204)
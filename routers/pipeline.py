@@ -1,11 +1,17 @@
 import asyncio
 import logging
+import os
+import time
 from typing import List, Optional
-from fastapi import APIRouter
-from pydantic import BaseModel, Field
+from fastapi import APIRouter, Query, Response
+from pydantic import BaseModel, Field, model_validator
 from fastapi.responses import JSONResponse
 
 import utils.job as jobs
+from utils import events, index, pools
+from utils.scheduler import scheduler
+
+PIPELINE_PARALLELISM = int(os.environ.get("RES_PIPELINE_PARALLELISM", "4"))
 
 
 class PipelineJob(BaseModel):
@@ -13,47 +19,282 @@ class PipelineJob(BaseModel):
     image: str
     script: List[str]
     artifacts: Optional[List[str]] = Field(default_factory=list)
+    cpus: Optional[float] = Field(default=None, gt=0)
+    memory: Optional[int] = Field(default=None, gt=0)
+    cache: bool = False
+    overlay: Optional[str] = None
+    needs: Optional[List[str]] = Field(
+        default=None,
+        description="Names of the jobs this job depends on, "
+        "by default the previous job in the pipeline",
+    )
 
 
 class PipelineDefinition(BaseModel):
-    jobs: List[PipelineJob] = Field(default_factory=list)
+    jobs: List[PipelineJob] = Field(min_length=1)
+    parallelism: Optional[int] = Field(default=None, gt=0)
+
+    def dependencies(self) -> dict[str, list[str]]:
+        """
+        Get the names of the jobs each job depends on.
+        """
+        needs = {}
+        for i, job in enumerate(self.jobs):
+            if job.needs is not None:
+                needs[job.name] = list(job.needs)
+            else:
+                needs[job.name] = [self.jobs[i - 1].name] if i > 0 else []
+        return needs
+
+    @model_validator(mode="after")
+    def check_graph(self):
+        names = [job.name for job in self.jobs]
+        if len(set(names)) != len(names):
+            raise ValueError("Job names must be unique")
+        needs = self.dependencies()
+        for name, deps in needs.items():
+            for dep in deps:
+                if dep not in needs:
+                    raise ValueError(f"Job '{name}' needs unknown job '{dep}'")
+        done: set[str] = set()
+        while len(done) < len(needs):
+            ready = [n for n in needs if n not in done and set(needs[n]) <= done]
+            if not ready:
+                raise ValueError("Job dependencies must not contain a cycle")
+            done.update(ready)
+        return self
+
+
+class PipelineJobStatus(BaseModel):
+    id: int
+    name: str
+    needs: List[str]
+    state: str
+    exit_code: Optional[int] = None
+    queued_at: Optional[float] = None
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    duration: Optional[float] = None
+
+
+class PipelineStatus(BaseModel):
+    id: int
+    state: str
+    created_at: float
+    finished_at: Optional[float] = None
+    error: Optional[str] = None
+    critical_path: List[str]
+    critical_path_duration: float
+    jobs: List[PipelineJobStatus]
+
+
+def job_failed(job: PipelineJobStatus) -> bool:
+    if jobs.is_done(job.state):
+        return job.exit_code not in (0, None)
+    return job.state in jobs.TERMINAL_STATES
+
+
+def pipeline_status(pipeline: dict) -> PipelineStatus:
+    """
+    Aggregate the state and timings of the pipeline jobs. The critical path is
+    the chain of dependencies with the longest total run time.
+    """
+    now = time.time()
+    statuses = []
+    for job in pipeline["jobs"]:
+        status = PipelineJobStatus(**job)
+        if status.started_at is not None:
+            status.duration = (status.finished_at or now) - status.started_at
+        statuses.append(status)
+    by_name = {job.name: job for job in statuses}
+
+    finished = all(job.state in jobs.TERMINAL_STATES for job in statuses)
+    if finished or pipeline["error"]:
+        failed = pipeline["error"] or any(job_failed(job) for job in statuses)
+        state = "failed" if failed else "done"
+    elif any(job.started_at is not None for job in statuses):
+        state = "running"
+    else:
+        state = "queued"
+
+    paths: dict[str, tuple[float, list[str]]] = {}
+
+    def longest(name: str) -> tuple[float, list[str]]:
+        if name not in paths:
+            before = max(
+                (longest(dep) for dep in by_name[name].needs), default=(0.0, [])
+            )
+            duration = by_name[name].duration or 0.0
+            paths[name] = (before[0] + duration, before[1] + [name])
+        return paths[name]
+
+    critical = max((longest(job.name) for job in statuses), default=(0.0, []))
+    finished_at = None
+    if state in ("done", "failed"):
+        finished_at = max((job.finished_at or 0.0 for job in statuses), default=None)
+
+    return PipelineStatus(
+        id=pipeline["id"],
+        state=state,
+        created_at=pipeline["created_at"],
+        finished_at=finished_at or None,
+        error=pipeline["error"],
+        critical_path=critical[1],
+        critical_path_duration=critical[0],
+        jobs=statuses,
+    )
 
 
 router = APIRouter()
 logger = logging.getLogger("uvicorn.error")
 
+running_pipelines: set[asyncio.Task] = set()
+
 
-async def execute_pipeline(ids: List[int]):
+class PipelineWatcher:
     """
-    Execute the pipeline by creating jobs and setting their states.
+    Publish the state changes of a pipeline, recomputed from the index on
+    every state change of its jobs.
     """
-    try:
-        for i in range(len(ids)):
-            jobs.set_state(ids[i], "started")
-            await jobs.launch_and_wait(ids[i])
-            if i < len(ids) - 1:
-                next_job = ids[i + 1]
-                jobs.cp_artifacts(ids[i], next_job)
-    except Exception as e:
-        logger.error(f"Error executing pipeline: {e}")
 
+    def __init__(self, pipeline_id: int, job_ids: list[int]):
+        self.pipeline_id = pipeline_id
+        self.subscription = events.Subscription(jobs=job_ids)
+        self.state: str | None = None
 
-@router.post("/", response_model=List[int])
-async def create_pipeline(pipeline: PipelineDefinition):
+    async def update(self):
+        _, pipelines = await pools.store.run(
+            index.query_pipelines, pipeline_id=self.pipeline_id
+        )
+        if not pipelines:
+            return
+        state = pipeline_status(pipelines[0]).state
+        if state != self.state:
+            self.state = state
+            events.publish("pipeline", self.pipeline_id, state)
+
+    async def watch(self):
+        while self.state not in ("done", "failed"):
+            await self.subscription.get()
+            await self.update()
+
+
+async def execute_pipeline(
+    pipeline_id: int, pipeline: PipelineDefinition, ids: dict[str, int]
+):
     """
-    Create a new pipeline definition.
+    Execute the pipeline jobs as soon as the jobs they need succeed. Artifacts
+    of every dependency are inputs of the job and jobs after a failure are
+    skipped.
     """
-    ids = []
-    for job in pipeline.jobs:
-        job_id = jobs.create_job()
-        ids.append(job_id)
-        properties = jobs.ImageProperties(image=job.image, artifacts=job.artifacts)
+    needs = pipeline.dependencies()
+    artifacts = {job.name: bool(job.artifacts) for job in pipeline.jobs}
+    semaphore = asyncio.Semaphore(pipeline.parallelism or PIPELINE_PARALLELISM)
+    tasks: dict[str, asyncio.Task] = {}
+    watcher = PipelineWatcher(pipeline_id, list(ids.values()))
+
+    async def run(name: str) -> bool:
+        results = await asyncio.gather(
+            *(tasks[dep] for dep in needs[name]), return_exceptions=True
+        )
+        job_id = ids[name]
+        # A dependency that raised did not succeed either.
+        if not all(result is True for result in results):
+            await pools.store.run(jobs.set_state, job_id, "skipped")
+            return False
         try:
-            jobs.update_job(job_id, properties)
-            jobs.put_script(job_id, "\n".join(job.script).encode("utf-8"))
-            jobs.set_state(job_id, "queued")
+            inputs = {dep: ids[dep] for dep in needs[name] if artifacts[dep]}
+            await pools.store.run(jobs.set_inputs, job_id, inputs)
         except jobs.JobException as e:
-            return JSONResponse(status_code=400, content={"detail": str(e)})
+            logger.error(f"Error passing artifacts to job {job_id}: {e}")
+            await pools.store.run(jobs.set_state, job_id, "failed")
+            return False
+        async with semaphore:
+            exit_code = await (await scheduler.submit(job_id))
+        return exit_code == 0
+
+    with watcher.subscription:
+        await watcher.update()
+        watching = asyncio.create_task(watcher.watch())
+        try:
+            for name in needs:
+                tasks[name] = asyncio.create_task(run(name))
+            results = await asyncio.gather(*tasks.values(), return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+        except Exception as e:
+            logger.error(f"Error executing pipeline {pipeline_id}: {e}")
+            await pools.store.run(index.set_pipeline_error, pipeline_id, str(e))
+        finally:
+            watching.cancel()
+        await watcher.update()
+
 
-    asyncio.create_task(execute_pipeline(ids))
+def create_jobs(pipeline: PipelineDefinition) -> dict[str, int]:
+    """
+    Create the queued jobs of a pipeline and get their IDs by name.
+    """
+    ids = {}
+    for job, job_id in zip(pipeline.jobs, jobs.create_jobs(len(pipeline.jobs))):
+        ids[job.name] = job_id
+        properties = jobs.ImageProperties(
+            image=job.image,
+            artifacts=job.artifacts,
+            cpus=job.cpus,
+            memory=job.memory,
+            cache=job.cache,
+            overlay=job.overlay,
+        )
+        jobs.update_job(job_id, properties)
+        jobs.put_script(job_id, "\n".join(job.script).encode("utf-8"))
+        jobs.set_state(job_id, "queued")
     return ids
+
+
+@router.post("/", response_model=List[int])
+async def create_pipeline(pipeline: PipelineDefinition, response: Response):
+    """
+    Create a new pipeline definition. Returns the IDs of the pipeline jobs, the
+    pipeline status is at the Location header.
+    """
+    try:
+        ids = await pools.store.run(create_jobs, pipeline)
+    except jobs.JobException as e:
+        return JSONResponse(status_code=400, content={"detail": str(e)})
+
+    needs = pipeline.dependencies()
+    pipeline_id = await pools.store.run(
+        index.create_pipeline,
+        [(job_id, name, needs[name]) for name, job_id in ids.items()],
+    )
+    task = asyncio.create_task(execute_pipeline(pipeline_id, pipeline, ids))
+    running_pipelines.add(task)
+    task.add_done_callback(running_pipelines.discard)
+    response.headers["Location"] = f"/pipelines/{pipeline_id}"
+    return list(ids.values())
+
+
+@router.get("/{pipeline_id}", response_model=PipelineStatus)
+async def get_pipeline(pipeline_id: int):
+    """
+    Get the state and timings of a pipeline and its jobs.
+    """
+    _, pipelines = await pools.store.run(index.query_pipelines, pipeline_id=pipeline_id)
+    if not pipelines:
+        return JSONResponse(status_code=404, content={"detail": "Pipeline not found"})
+    return pipeline_status(pipelines[0])
+
+
+@router.get("/")
+async def list_pipelines(skip: int = Query(0, ge=0), limit: int = Query(10, gt=0)):
+    """
+    List the most recent pipelines with their status, with pagination support.
+    """
+    total, pipelines = await pools.store.run(index.query_pipelines, skip, limit)
+    return {
+        "total": total,
+        "skip": skip,
+        "limit": limit,
+        "items": [pipeline_status(pipeline).model_dump() for pipeline in pipelines],
+    }
@@ -0,0 +1,23 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run(cwd: str, code: str) -> str:
+    """
+    Run code in a fresh interpreter, as the service would start in cwd, and
+    get its output.
+    """
+    env = dict(os.environ, PYTHONPATH=ROOT, RES_EXECUTOR="local")
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=cwd,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode:
+        raise AssertionError(result.stderr)
+    return result.stdout
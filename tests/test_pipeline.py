@@ -0,0 +1,71 @@
+import json
+import os
+import tempfile
+import unittest
+
+from tests import run
+
+# Runs a pipeline a -> b -> c, c also needing d, where the submission of a
+# raises, and prints the states of the jobs and the pipeline error.
+RAISING_DEPENDENCY = """
+import asyncio, json
+from unittest import mock
+import utils.job as jobs
+from routers import pipeline
+from utils import index
+from utils.scheduler import scheduler
+
+definition = pipeline.PipelineDefinition(
+    jobs=[
+        {"name": "a", "image": "x", "script": ["true"]},
+        {"name": "b", "image": "x", "script": ["true"]},
+        {"name": "d", "image": "x", "script": ["true"], "needs": []},
+        {"name": "c", "image": "x", "script": ["true"], "needs": ["b", "d"]},
+    ]
+)
+needs = definition.dependencies()
+
+
+async def submit(job_id):
+    if job_id == ids["a"]:
+        raise RuntimeError("submit failed")
+    future = asyncio.get_running_loop().create_future()
+    future.set_result(0)
+    return future
+
+
+ids = pipeline.create_jobs(definition)
+pipeline_id = index.create_pipeline(
+    [(job_id, name, needs[name]) for name, job_id in ids.items()]
+)
+with mock.patch.object(scheduler, "submit", submit):
+    asyncio.run(
+        asyncio.wait_for(pipeline.execute_pipeline(pipeline_id, definition, ids), 10)
+    )
+_, pipelines = index.query_pipelines(pipeline_id=pipeline_id)
+print(
+    json.dumps(
+        {
+            "states": {name: jobs.job_state(job_id) for name, job_id in ids.items()},
+            "error": pipelines[0]["error"],
+        }
+    )
+)
+"""
+
+
+class PipelineTest(unittest.TestCase):
+    def test_dependency_raises(self):
+        with tempfile.TemporaryDirectory() as cwd:
+            os.makedirs(f"{cwd}/.store/images")
+            with open(f"{cwd}/.store/images/x.sif", "wb") as f:
+                f.write(b"image")
+
+            result = json.loads(run(cwd, RAISING_DEPENDENCY))
+            self.assertEqual(result["states"]["b"], "skipped")
+            self.assertEqual(result["states"]["c"], "skipped")
+            self.assertEqual(result["error"], "submit failed")
+
+
+if __name__ == "__main__":
+    unittest.main()
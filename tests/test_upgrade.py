@@ -0,0 +1,35 @@
+import json
+import os
+import tempfile
+import unittest
+
+from tests import run
+
+
+class UpgradeTest(unittest.TestCase):
+    def test_store_without_index(self):
+        with tempfile.TemporaryDirectory() as cwd:
+            # Flat store written before the job index existed.
+            for job_id in range(1, 121):
+                path = f"{cwd}/.store/jobs/{job_id}"
+                os.makedirs(path)
+                for name in ("properties", "image.sif", "script"):
+                    open(f"{path}/{name}", "w").close()
+                os.setxattr(f"{path}/properties", "user.state", b"done")
+            with open(f"{cwd}/.store/jobs/max_job_id.txt", "w") as f:
+                f.write("120")
+
+            out = run(
+                cwd,
+                "import json, main\n"
+                "from utils import index\n"
+                "print(json.dumps(index.query_jobs('', 0, 1000)))",
+            )
+            total, ids = json.loads(out)
+            self.assertEqual(total, 120)
+            self.assertEqual(ids, list(range(1, 121)))
+            self.assertTrue(os.path.exists(f"{cwd}/.store/index.db"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,212 @@
+import hashlib
+import os
+import stat
+import tarfile
+import uuid
+import zipfile
+from typing import Iterator
+
+from utils import index
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CHUNK_SIZE = 1024 * 1024
+CACHE_DIR = "archives"
+CACHE_SIZE = int(os.environ.get("RES_ARCHIVE_CACHE_SIZE", 10 * 1024**3))
+
+DEFAULT_FORMAT = "zip-deflate"
+
+FORMATS = {
+    "zip-deflate": ("application/zip", "zip"),
+    "zip-stored": ("application/zip", "zip"),
+    "tar": ("application/x-tar", "tar"),
+    "tar.zst": ("application/zstd", "tar.zst"),
+}
+
+ACCEPT_FORMATS = {
+    "application/zip": "zip-deflate",
+    "application/x-zip-compressed": "zip-deflate",
+    "application/x-tar": "tar",
+    "application/zstd": "tar.zst",
+    "application/x-zstd": "tar.zst",
+}
+
+
+class ArchiveException(Exception):
+    def __init__(self, message: str):
+        super().__init__(message)
+        self.message = message
+
+
+class _Pipe:
+    """
+    Write-only file object collecting the bytes written by an archiver.
+    """
+
+    def __init__(self):
+        self.chunks: list[bytes] = []
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def available_formats() -> list[str]:
+    return [f for f in FORMATS if f != "tar.zst" or zstandard is not None]
+
+
+def negotiate(fmt: str | None, accept: str | None) -> str:
+    """
+    Pick the archive format from the query parameter or the Accept header.
+    """
+    if fmt:
+        if fmt not in available_formats():
+            raise ArchiveException(f"Format must be one of {available_formats()}")
+        return fmt
+    if not accept:
+        return DEFAULT_FORMAT
+    for media_type in accept.split(","):
+        media_type = media_type.split(";")[0].strip().lower()
+        if media_type in ("*/*", "application/*"):
+            return DEFAULT_FORMAT
+        fmt = ACCEPT_FORMATS.get(media_type)
+        if fmt in available_formats():
+            return fmt
+    raise ArchiveException(f"Accept must allow one of {available_formats()}")
+
+
+def media_type(fmt: str) -> str:
+    return FORMATS[fmt][0]
+
+
+def extension(fmt: str) -> str:
+    return FORMATS[fmt][1]
+
+
+def iter_archive(files: list[tuple[str, str]], fmt: str) -> Iterator[bytes]:
+    """
+    Stream an archive of (path, arcname) files chunk by chunk.
+    """
+    if fmt == "zip-deflate":
+        chunks = _iter_zip(files, zipfile.ZIP_DEFLATED)
+    elif fmt == "zip-stored":
+        chunks = _iter_zip(files, zipfile.ZIP_STORED)
+    elif fmt == "tar":
+        chunks = _iter_tar(files)
+    elif fmt == "tar.zst" and zstandard is not None:
+        chunks = _iter_zstd(_iter_tar(files))
+    else:
+        raise ArchiveException(f"Unsupported archive format {fmt}")
+    for chunk in chunks:
+        if chunk:
+            yield chunk
+
+
+def _iter_zip(files: list[tuple[str, str]], compression: int) -> Iterator[bytes]:
+    pipe = _Pipe()
+    with zipfile.ZipFile(pipe, "w", compression) as zip_file:
+        for path, arcname in files:
+            info = zipfile.ZipInfo.from_file(path, arcname)
+            info.compress_type = compression
+            if info.is_dir():
+                zip_file.writestr(info, b"")
+                continue
+            with open(path, "rb") as src, zip_file.open(info, "w") as dst:
+                while chunk := src.read(CHUNK_SIZE):
+                    dst.write(chunk)
+                    yield pipe.drain()
+            yield pipe.drain()
+    yield pipe.drain()
+
+
+def _iter_tar(files: list[tuple[str, str]]) -> Iterator[bytes]:
+    written = 0
+    for path, arcname in files:
+        st = os.stat(path)
+        info = tarfile.TarInfo(arcname)
+        info.mtime = int(st.st_mtime)
+        info.mode = stat.S_IMODE(st.st_mode)
+        if stat.S_ISDIR(st.st_mode):
+            info.type = tarfile.DIRTYPE
+        else:
+            info.size = st.st_size
+        header = info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+        written += len(header)
+        yield header
+        if info.isdir():
+            continue
+        remaining = info.size
+        with open(path, "rb") as src:
+            while remaining > 0:
+                chunk = src.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    # The file shrank while streaming, pad with zeros.
+                    chunk = b"\0" * min(CHUNK_SIZE, remaining)
+                remaining -= len(chunk)
+                written += len(chunk)
+                yield chunk
+        padding = -info.size % tarfile.BLOCKSIZE
+        written += padding
+        yield b"\0" * padding
+    end = 2 * tarfile.BLOCKSIZE
+    end += -(written + end) % tarfile.RECORDSIZE
+    yield b"\0" * end
+
+
+def _iter_zstd(chunks: Iterator[bytes]) -> Iterator[bytes]:
+    compressor = zstandard.ZstdCompressor().compressobj()
+    for chunk in chunks:
+        yield compressor.compress(chunk)
+    yield compressor.flush()
+
+
+def cache_key(files: list[tuple[str, str]], fmt: str) -> str:
+    """
+    Hash the archive format and the name, size and mtime of every file.
+    """
+    key = hashlib.sha256(fmt.encode())
+    for path, arcname in files:
+        st = os.stat(path)
+        key.update(f"\0{arcname}\0{st.st_size}\0{st.st_mtime_ns}".encode())
+    return key.hexdigest()
+
+
+def cached_archive(
+    job_path: str, files: list[tuple[str, str]], fmt: str, key: str | None = None
+):
+    """
+    Get the path and key of the archive stored next to the job, building it
+    on the first request. The key defaults to cache_key. Least recently used
+    archives are evicted when the cache exceeds CACHE_SIZE bytes.
+    """
+    if key is None:
+        key = cache_key(files, fmt)
+    cache_dir = f"{job_path}/{CACHE_DIR}"
+    path = f"{cache_dir}/{key}.{extension(fmt)}"
+    if not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                for chunk in iter_archive(files, fmt):
+                    f.write(chunk)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    index.touch_cached("archives", path, os.path.getsize(path))
+    for evicted in index.evict_cached("archives", CACHE_SIZE, keep=path):
+        if os.path.exists(evicted):
+            os.remove(evicted)
+    return path, key
@@ -0,0 +1,142 @@
+import hashlib
+import logging
+import os
+import shutil
+import uuid
+
+import utils.job as jobs
+from utils import fs, index, joblog, overlay
+
+logger = logging.getLogger("uvicorn.error")
+
+BUILD_CACHE_STORE = ".store/cache"
+BUILD_CACHE_SIZE = int(os.environ.get("RES_BUILD_CACHE_SIZE", 20 * 1024**3))
+CHUNK_SIZE = 1024 * 1024
+
+os.makedirs(BUILD_CACHE_STORE, exist_ok=True)
+
+# A cache entry BUILD_CACHE_STORE/<key> holds private copies, reflinks where
+# the filesystem supports them, of the artifacts (root/) and the log of a
+# successful job. Entries never share inodes with jobs, which may rewrite
+# their files when they run again. The key hashes everything the
+# result depends on: image digest, script hash, artifact list, overlay
+# template, the manifests of the input jobs and the files present in the job
+# root before it runs.
+
+
+def file_hash(path: str) -> str:
+    hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            hash.update(chunk)
+    return hash.hexdigest()
+
+
+def job_key(job_id: int) -> str | None:
+    """
+    Get the cache key of a job, None when the job did not opt in.
+    """
+    if not jobs.job_cached(job_id):
+        return None
+    job = jobs.job_from_id(job_id)
+    script_hash = jobs.get_script_etag(job_id)
+    if job is None or not job.image_digest or script_hash is None:
+        return None
+
+    key = hashlib.sha256()
+    key.update(f"{job.image_digest}\0{script_hash}\0".encode())
+    key.update("\0".join(job.artifacts).encode() + b"\0\0")
+    if job.overlay is not None:
+        template_key = overlay.template_key(job.overlay)
+        if template_key is None:
+            return None
+        key.update(f"overlay\0{template_key}\0".encode())
+    for name, upstream in sorted(jobs.job_inputs(job_id).items()):
+        key.update(f"input\0{name}\0".encode())
+        for artifact in jobs.read_manifest(upstream) or []:
+            key.update(f"{artifact.name}\0{artifact.sha256}\0".encode())
+    root = f"{jobs.job_dir(job_id)}/{jobs.ROOT_MOUNT}"
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            if os.path.isfile(path):
+                name = os.path.relpath(path, root)
+                key.update(f"{name}\0{file_hash(path)}\0".encode())
+    return key.hexdigest()
+
+
+def _clone(src: str, dst: str):
+    if os.path.lexists(dst):
+        os.remove(dst)
+    fs.clone(src, dst, link=False)
+
+
+def _clone_tree(src: str, dst: str):
+    if os.path.isdir(src) and not os.path.islink(src):
+        shutil.copytree(
+            src, dst, symlinks=True, copy_function=_clone, dirs_exist_ok=True
+        )
+    else:
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        _clone(src, dst)
+
+
+def _tree_size(path: str) -> int:
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            size += os.lstat(os.path.join(dirpath, filename)).st_size
+    return size
+
+
+def restore(key: str, job_id: int) -> bool:
+    """
+    Copy the cached artifacts and log into the job, if the key is cached.
+    """
+    entry = f"{BUILD_CACHE_STORE}/{key}"
+    if not os.path.isdir(entry):
+        return False
+    job_path = jobs.job_dir(job_id)
+    try:
+        _clone_tree(f"{entry}/{jobs.ROOT_MOUNT}", f"{job_path}/{jobs.ROOT_MOUNT}")
+        joblog.discard(f"{job_path}/{jobs.LOG_FILE}")
+        for path in joblog.files(f"{entry}/{jobs.LOG_FILE}"):
+            _clone_tree(path, f"{job_path}/{os.path.basename(path)}")
+    except OSError as e:
+        logger.error(f"Cannot restore build cache {key} into job {job_id}: {e}")
+        return False
+    jobs.set_exit_code(job_id, 0)
+    index.touch_cached("build_cache", entry, _tree_size(entry))
+    logger.info(f"Job {job_id} restored from build cache {key}")
+    return True
+
+
+def save(key: str, job_id: int):
+    """
+    Store the artifacts and log of a successful job under the key and evict
+    the least recently used entries above BUILD_CACHE_SIZE bytes.
+    """
+    entry = f"{BUILD_CACHE_STORE}/{key}"
+    if not os.path.isdir(entry):
+        job_path = jobs.job_dir(job_id)
+        tmp = f"{entry}.{uuid.uuid4().hex}.tmp"
+        try:
+            files = jobs.artifact_files(job_id)
+        except jobs.JobException:
+            files = []
+        try:
+            os.makedirs(f"{tmp}/{jobs.ROOT_MOUNT}")
+            for path, name in files:
+                _clone_tree(path, f"{tmp}/{jobs.ROOT_MOUNT}/{name}")
+            for path in joblog.files(f"{job_path}/{jobs.LOG_FILE}"):
+                _clone_tree(path, f"{tmp}/{os.path.basename(path)}")
+            os.rename(tmp, entry)
+        except OSError as e:
+            logger.error(f"Cannot save job {job_id} to build cache {key}: {e}")
+            return
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+    index.touch_cached("build_cache", entry, _tree_size(entry))
+    for evicted in index.evict_cached("build_cache", BUILD_CACHE_SIZE, keep=entry):
+        shutil.rmtree(evicted, ignore_errors=True)
@@ -0,0 +1,148 @@
+import asyncio
+import itertools
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Iterable
+
+from utils import metrics
+
+EVENTS_HISTORY = int(os.environ.get("RES_EVENTS_HISTORY", "1000"))
+EVENTS_QUEUE_SIZE = 1000
+
+# Job and pipeline state changes are published here by whoever changes the
+# state, from the event loop or from a pool thread, and delivered on the
+# event loop to the subscriptions interested in them. Subscriptions are
+# indexed by job and pipeline ID, so a change only wakes its own watchers
+# and the unfiltered feeds, whatever the number of waiting clients.
+
+_loop: asyncio.AbstractEventLoop | None = None
+_lock = threading.Lock()
+_ids = itertools.count(1)
+_history: deque[dict] = deque(maxlen=EVENTS_HISTORY)
+_feeds: set["Subscription"] = set()
+_watchers: dict[tuple[str, int], set["Subscription"]] = {}
+
+
+class Subscription:
+    """
+    Queue of the events of some jobs and pipelines, or of all of them when no
+    IDs are given. When a subscriber is too slow to keep up, its queued events
+    are dropped and get returns None once, so that event streams end and their
+    clients resume from the history.
+    """
+
+    def __init__(self, jobs: Iterable[int] = (), pipelines: Iterable[int] = ()):
+        self.keys = {("job", id) for id in jobs} | {
+            ("pipeline", id) for id in pipelines
+        }
+        self.queue: asyncio.Queue[dict | None] = asyncio.Queue(EVENTS_QUEUE_SIZE)
+        self.lost = False
+
+    def put(self, event: dict):
+        if self.lost:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.lost = True
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(None)
+
+    def wants(self, event: dict) -> bool:
+        return not self.keys or (event["type"], event["id"]) in self.keys
+
+    async def get(self, timeout: float | None = None) -> dict | None:
+        """
+        Get the next event, None once when events were lost.
+        """
+        event = await asyncio.wait_for(self.queue.get(), timeout)
+        if event is None:
+            self.lost = False
+        return event
+
+    def __enter__(self):
+        global _loop
+        _loop = asyncio.get_running_loop()
+        if not self.keys:
+            _feeds.add(self)
+        for key in self.keys:
+            _watchers.setdefault(key, set()).add(self)
+        return self
+
+    def __exit__(self, *exc):
+        _feeds.discard(self)
+        for key in self.keys:
+            watchers = _watchers.get(key)
+            if watchers is not None:
+                watchers.discard(self)
+                if not watchers:
+                    del _watchers[key]
+
+
+def _dispatch(event: dict):
+    for subscription in list(_feeds):
+        subscription.put(event)
+    for subscription in list(_watchers.get((event["type"], event["id"]), ())):
+        subscription.put(event)
+
+
+def publish(type: str, id: int, state: str, **data):
+    """
+    Publish the new state of a job or pipeline. Safe to call from any thread.
+    """
+    with _lock:
+        event = {
+            "seq": next(_ids),
+            "type": type,
+            "id": id,
+            "state": state,
+            "time": time.time(),
+            **data,
+        }
+        _history.append(event)
+    metrics.events_published.inc(type=type)
+    loop = _loop
+    if loop is None or loop.is_closed():
+        return
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        _dispatch(event)
+        return
+    try:
+        loop.call_soon_threadsafe(_dispatch, event)
+    except RuntimeError:
+        pass
+
+
+def history(after: int) -> list[dict]:
+    """
+    Get the kept events published after the sequence number.
+    """
+    with _lock:
+        return [event for event in _history if event["seq"] > after]
+
+
+def format_sse(event: dict) -> bytes:
+    """
+    Format an event for a text/event-stream response.
+    """
+    data = json.dumps({k: v for k, v in event.items() if k != "seq"})
+    return f"id: {event['seq']}\nevent: {event['type']}\ndata: {data}\n\n".encode()
+
+
+metrics.Gauge(
+    "res_event_subscriptions",
+    "Open event feeds and job or pipeline watchers",
+    ("kind",),
+    callback=lambda: {
+        ("feed",): len(_feeds),
+        ("watcher",): sum(len(s) for s in list(_watchers.values())),
+    },
+)
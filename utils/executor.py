@@ -0,0 +1,191 @@
+import asyncio
+import logging
+import os
+import shutil
+import signal
+import subprocess
+
+import utils.job as jobs
+from utils import image as image_store, joblog, metrics, overlay, pools
+
+logger = logging.getLogger("uvicorn.error")
+
+EXECUTOR = os.environ.get("RES_EXECUTOR", "apptainer")
+
+
+class Executor:
+    """
+    Run the script of a job, with its output in the job log, and return the
+    exit code of the process. Backends provide the command to run.
+    """
+
+    name = ""
+
+    def prepare(self, job_id: int) -> list[str]:
+        """
+        Set up the job directory and get the command running the script. Runs
+        in the store pool.
+        """
+        raise NotImplementedError
+
+    def cwd(self, job_id: int) -> str | None:
+        return None
+
+    def env(self, job_id: int) -> dict[str, str]:
+        """
+        Get the variables added to the environment of the process.
+        """
+        return {}
+
+    def launch(self, job_id: int) -> tuple[list[str], str | None, dict[str, str], str]:
+        """
+        Get the command, working directory and environment of the process and
+        the path of the job log.
+        """
+        job_path = jobs.job_dir(job_id)
+        script_path = os.path.abspath(f"{job_path}/{jobs.SCRIPT_NAME}")
+        if not os.path.exists(script_path):
+            raise jobs.LaunchException("Script not found")
+        os.makedirs(f"{job_path}/{jobs.ROOT_MOUNT}", exist_ok=True)
+        cmd = self.prepare(job_id)
+        env = {**os.environ, **self.env(job_id)}
+        return cmd, self.cwd(job_id), env, f"{job_path}/{jobs.LOG_FILE}"
+
+    async def __call__(self, job_id: int) -> int:
+        cmd, cwd, env, log_path = await pools.store.run(self.launch, job_id)
+        logger.info(f"Launching job {job_id} with {self.name}: {' '.join(cmd)}")
+
+        log = await pools.store.run(joblog.LogWriter, log_path)
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                cwd=cwd,
+                env=env,
+                start_new_session=True,
+            )
+            try:
+                while chunk := await process.stdout.read(joblog.CHUNK_SIZE):
+                    await pools.store.run(log.write, chunk)
+                exit_code = await process.wait()
+            except asyncio.CancelledError:
+                # Kill the whole process group, children of the script
+                # would otherwise keep the output pipe open.
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                await process.wait()
+                raise
+        finally:
+            await pools.store.run(log.close)
+        await pools.store.run(jobs.set_exit_code, job_id, exit_code)
+        metrics.job_log_bytes.observe(log.total)
+        try:
+            await pools.cpu.run(joblog.compress, log_path)
+        except OSError as e:
+            logger.error(f"Cannot compress log of job {job_id}: {e}")
+        logger.info(f"Job {job_id} completed with exit code: {exit_code}")
+        return exit_code
+
+
+class ApptainerExecutor(Executor):
+    """
+    Run the script in the job image with the job root mounted at /root, the
+    job resource limits and an overlay.
+    """
+
+    name = "apptainer"
+
+    def prepare(self, job_id: int) -> list[str]:
+        job_path = os.path.abspath(jobs.job_dir(job_id))
+        script_path = f"{job_path}/{jobs.SCRIPT_NAME}"
+        image_path = f"{job_path}/{jobs.IMAGE_NAME}"
+        if not os.path.exists(image_path):
+            raise jobs.LaunchException("Image not found")
+        overlay_path = f"{job_path}/{jobs.OVERLAY_DIR}"
+        os.makedirs(overlay_path, exist_ok=True)
+
+        overlays = ["--overlay", overlay_path]
+        template = jobs.job_overlay(job_id)
+        if template is not None:
+            base_path = f"{job_path}/{jobs.BASE_DIR}"
+            image_digest = image_store.get_digest(image_path) or ""
+            shutil.rmtree(base_path, ignore_errors=True)
+            shutil.rmtree(overlay_path, ignore_errors=True)
+            os.makedirs(overlay_path)
+            try:
+                overlay.snapshot(template, image_digest, base_path)
+            except (overlay.OverlayException, OSError) as e:
+                raise jobs.LaunchException(f"Cannot snapshot overlay template: {e}")
+            overlays = ["--overlay", f"{base_path}:ro"] + overlays
+
+        limits = []
+        cpus, memory = jobs.job_resources(job_id)
+        if cpus is not None:
+            limits += ["--cpus", str(cpus)]
+        if memory is not None:
+            limits += ["--memory", f"{memory}M"]
+
+        # Only the artifacts of the upstream manifests are exposed, as links
+        # in a directory mounted read-only, like the copies of LocalExecutor.
+        inputs = []
+        if jobs.job_inputs(job_id):
+            inputs_path = os.path.abspath(jobs.copy_inputs(job_id, link=True))
+            inputs = ["--bind", f"{inputs_path}:{jobs.INPUTS_MOUNT}:ro"]
+
+        root_mount = f"{job_path}/{jobs.ROOT_MOUNT}"
+        return [
+            "apptainer",
+            "exec",
+            "-C",
+            "--fakeroot",
+            *limits,
+            "--bind",
+            script_path,
+            "--bind",
+            f"{root_mount}:/root/",
+            *inputs,
+            "--env",
+            f"RES_INPUTS={jobs.INPUTS_MOUNT}",
+            *overlays,
+            image_path,
+            script_path,
+        ]
+
+
+class LocalExecutor(Executor):
+    """
+    Run the script directly on the host in the job root, without image,
+    overlay or resource limits. Inputs are cloned since there are no mounts.
+    Meant for tests and benchmarks.
+    """
+
+    name = "local"
+
+    def prepare(self, job_id: int) -> list[str]:
+        if jobs.job_inputs(job_id):
+            jobs.copy_inputs(job_id)
+        script_path = os.path.abspath(f"{jobs.job_dir(job_id)}/{jobs.SCRIPT_NAME}")
+        return ["bash", script_path]
+
+    def cwd(self, job_id: int) -> str | None:
+        return f"{jobs.job_dir(job_id)}/{jobs.ROOT_MOUNT}"
+
+    def env(self, job_id: int) -> dict[str, str]:
+        inputs = os.path.abspath(f"{jobs.job_dir(job_id)}/{jobs.INPUTS_DIR}")
+        return {"RES_INPUTS": inputs}
+
+
+EXECUTORS: dict[str, type[Executor]] = {
+    ApptainerExecutor.name: ApptainerExecutor,
+    LocalExecutor.name: LocalExecutor,
+}
+
+
+def get_executor(name: str = EXECUTOR) -> Executor:
+    if name not in EXECUTORS:
+        raise ValueError(f"Executor must be one of {list(EXECUTORS)}, not '{name}'")
+    return EXECUTORS[name]()
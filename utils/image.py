@@ -0,0 +1,462 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import AsyncIterator
+
+from utils import index, pools, sif
+
+logger = logging.getLogger("uvicorn.error")
+
+IMAGES_STORE = ".store/images"
+BLOBS_STORE = f"{IMAGES_STORE}/blobs/sha256"
+UPLOADS_STORE = f"{IMAGES_STORE}/uploads"
+HASH_ATTR = "user.hash"
+UPLOAD_NAME_ATTR = "user.image_name"
+CHUNK_SIZE = 1024 * 1024
+UPLOAD_MAX_AGE = int(os.environ.get("RES_UPLOAD_MAX_AGE", 24 * 3600))
+
+os.makedirs(BLOBS_STORE, exist_ok=True)
+os.makedirs(UPLOADS_STORE, exist_ok=True)
+
+# Running hashes of upload sessions, keyed by upload ID, with the offset they
+# cover. Sessions missing here (e.g. after a restart) are rehashed from disk.
+_upload_hashes: dict[str, tuple[int, "hashlib._Hash"]] = {}
+# Requests appending to or finishing a session hold its lock, so that their
+# offset checks and writes never interleave.
+_upload_locks: dict[str, asyncio.Lock] = {}
+
+# Images are stored once per content in BLOBS_STORE/<sha256>. Tags
+# ({name}.sif) and the image.sif of jobs are hard links to the blob, so the
+# link count of a blob is its reference count. Linking and removing blobs
+# is serialized by _lock, so a blob is never collected while it is linked.
+_lock = threading.RLock()
+
+# The catalog holds the properties of every tag, sorted by name, so that
+# listing images and reading their properties do not touch the filesystem.
+# Entries are built once when a tag changes, including the metadata parsed
+# from the SIF header, and written through to the index. At startup the
+# catalog is loaded from the index and only tags whose digest changed while
+# the service was down are read again.
+_catalog_lock = threading.Lock()
+_catalog: dict[str, dict] = {}
+_names: list[str] = []
+_catalog_etag = '""'
+
+
+class ImageException(Exception):
+    def __init__(self, message: str):
+        super().__init__(message)
+        self.message = message
+
+
+def tag_path(name: str) -> str:
+    return f"{IMAGES_STORE}/{name}.sif"
+
+
+def check_name(name: str):
+    """
+    Check that name can be stored as a tag. Names starting with a dot are
+    reserved for temporary files and not listed by the catalog.
+    """
+    if not name or name.startswith("."):
+        raise ImageException("Image names must not start with '.'")
+
+
+def blob_path(digest: str) -> str:
+    return f"{BLOBS_STORE}/{digest}"
+
+
+def tmp_path(name: str) -> str:
+    return f"{IMAGES_STORE}/.{name}.sif.{uuid.uuid4().hex}.tmp"
+
+
+def discard_tmp(path: str):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def get_digest(path: str) -> str | None:
+    try:
+        return os.getxattr(path, HASH_ATTR).decode("utf-8")
+    except OSError:
+        return None
+
+
+def references(digest: str) -> int:
+    """
+    Get the number of tags and jobs referencing the blob.
+    """
+    try:
+        return os.stat(blob_path(digest)).st_nlink - 1
+    except FileNotFoundError:
+        return 0
+
+
+def _link(src: str, dst: str):
+    """
+    Atomically make dst a hard link to src.
+    """
+    tmp = f"{dst}.{uuid.uuid4().hex}.tmp"
+    os.link(src, tmp)
+    os.replace(tmp, dst)
+    # rename() is a no-op when both names already link the same file.
+    if os.path.exists(tmp):
+        os.remove(tmp)
+
+
+def commit(name: str, path: str, digest: str):
+    """
+    Store the hashed file as a blob, unless it is already stored, and point
+    the tag at it.
+    """
+    tag = tag_path(name)
+    blob = blob_path(digest)
+    with _lock:
+        old = get_digest(tag)
+        if os.path.exists(blob):
+            os.remove(path)
+            _link(blob, tag)
+        else:
+            # The data is linked to a tag before the blob is published, so
+            # a blob is never seen without references.
+            os.setxattr(path, HASH_ATTR, digest.encode("utf-8"))
+            tmp = f"{tag}.{uuid.uuid4().hex}.tmp"
+            os.link(path, tmp)
+            try:
+                os.replace(path, blob)
+                os.replace(tmp, tag)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+        _catalog_put(_read_entry(name, digest, time.time()))
+        if old is not None and old != digest:
+            release(old)
+
+
+def delete(name: str):
+    path = tag_path(name)
+    with _lock:
+        if not os.path.exists(path):
+            raise ImageException(f"Image '{name}' not found")
+        digest = get_digest(path)
+        os.remove(path)
+        _catalog_remove(name)
+        if digest is not None:
+            release(digest)
+
+
+def pin(name: str, dst: str) -> str:
+    """
+    Link the blob currently tagged name to dst and return its digest. The
+    blob dst linked before is removed when nothing else references it.
+    """
+    path = tag_path(name)
+    with _lock:
+        if not os.path.exists(path):
+            raise ImageException("Image not found")
+        digest = get_digest(path)
+        if digest is None or not os.path.samefile(path, blob_path(digest)):
+            digest = adopt(name)
+        old = get_digest(dst)
+        _link(blob_path(digest), dst)
+        if old is not None and old != digest:
+            release(old)
+    return digest
+
+
+def adopt(name: str) -> str:
+    """
+    Move an image stored before the blob store into it.
+    """
+    path = tag_path(name)
+    with _lock:
+        digest = get_digest(path)
+        if digest is None:
+            hash = hashlib.sha256()
+            with open(path, "rb") as f:
+                while chunk := f.read(CHUNK_SIZE):
+                    hash.update(chunk)
+            digest = hash.hexdigest()
+        blob = blob_path(digest)
+        if not os.path.exists(blob):
+            os.setxattr(path, HASH_ATTR, digest.encode("utf-8"))
+            os.link(path, blob)
+        else:
+            _link(blob, path)
+    return digest
+
+
+def release(digest: str) -> int:
+    """
+    Remove the blob if it is not referenced by any tag or job anymore and
+    return the bytes freed.
+    """
+    with _lock:
+        try:
+            st = os.stat(blob_path(digest))
+        except FileNotFoundError:
+            return 0
+        if st.st_nlink > 1:
+            return 0
+        os.remove(blob_path(digest))
+    logger.info(f"Removed unreferenced image blob {digest}")
+    return st.st_blocks * 512
+
+
+def gc() -> dict[str, int]:
+    """
+    Remove blobs that are not referenced by any tag or job and get the bytes
+    freed by digest.
+    """
+    freed = {digest: release(digest) for digest in os.listdir(BLOBS_STORE)}
+    return {digest: size for digest, size in freed.items() if size}
+
+
+def upload_path(upload_id: str, name: str) -> str:
+    """
+    Get the file of the upload session, which must have been started for the
+    image name.
+    """
+    try:
+        upload_id = uuid.UUID(hex=upload_id).hex
+    except ValueError:
+        raise ImageException("Upload not found")
+    path = f"{UPLOADS_STORE}/{upload_id}"
+    try:
+        upload_name = os.getxattr(path, UPLOAD_NAME_ATTR).decode("utf-8")
+    except OSError:
+        raise ImageException("Upload not found")
+    if upload_name != name:
+        raise ImageException("Upload not found")
+    return path
+
+
+def create_upload(name: str) -> str:
+    """
+    Start an upload session of the image name and return its ID.
+    """
+    now = time.time()
+    for upload_id in os.listdir(UPLOADS_STORE):
+        path = f"{UPLOADS_STORE}/{upload_id}"
+        if now - os.path.getmtime(path) > UPLOAD_MAX_AGE:
+            os.remove(path)
+            _upload_hashes.pop(upload_id, None)
+            _upload_locks.pop(upload_id, None)
+    upload_id = uuid.uuid4().hex
+    path = f"{UPLOADS_STORE}/{upload_id}"
+    open(path, "wb").close()
+    os.setxattr(path, UPLOAD_NAME_ATTR, name.encode("utf-8"))
+    _upload_hashes[upload_id] = (0, hashlib.sha256())
+    return upload_id
+
+
+def upload_lock(upload_id: str) -> asyncio.Lock:
+    """
+    Get the lock of the upload session.
+    """
+    return _upload_locks.setdefault(upload_id, asyncio.Lock())
+
+
+def upload_offset(upload_id: str, name: str) -> int:
+    """
+    Get the number of bytes committed to the upload session.
+    """
+    return os.path.getsize(upload_path(upload_id, name))
+
+
+def _upload_hash(upload_id: str, path: str):
+    offset = os.path.getsize(path)
+    cached = _upload_hashes.get(upload_id)
+    if cached is not None and cached[0] == offset:
+        return cached[1]
+    hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            hash.update(chunk)
+    return hash
+
+
+async def append_upload(
+    upload_id: str, name: str, start: int, chunks: AsyncIterator[bytes]
+) -> int:
+    """
+    Append the chunks at start, which must be the committed offset, and
+    return the new offset. The caller holds the lock of the session.
+    """
+    path = await pools.store.run(upload_path, upload_id, name)
+    if start != await pools.store.run(os.path.getsize, path):
+        raise ImageException("Range does not start at the upload offset")
+    hash = await pools.cpu.run(_upload_hash, upload_id, path)
+    # The running hash is updated in place and kept again only once every
+    # chunk is written, the session is rehashed from disk otherwise.
+    _upload_hashes.pop(upload_id, None)
+    offset = start
+    f = await pools.store.run(open, path, "ab")
+    try:
+        async for chunk in chunks:
+            await asyncio.gather(
+                pools.store.run(f.write, chunk), pools.cpu.run(hash.update, chunk)
+            )
+            offset += len(chunk)
+    finally:
+        await pools.store.run(f.close)
+    _upload_hashes[upload_id] = (offset, hash)
+    return offset
+
+
+def finish_upload(name: str, upload_id: str, digest: str) -> str:
+    """
+    Check the digest of the uploaded data and store it as the image name.
+    """
+    path = upload_path(upload_id, name)
+    if os.path.getsize(path) == 0:
+        raise ImageException("Upload is empty")
+    actual = _upload_hash(upload_id, path).hexdigest()
+    if digest.removeprefix("sha256:") != actual:
+        raise ImageException(f"Digest mismatch, uploaded data has sha256:{actual}")
+    os.removexattr(path, UPLOAD_NAME_ATTR)
+    commit(name, path, actual)
+    _upload_hashes.pop(upload_id, None)
+    _upload_locks.pop(upload_id, None)
+    return actual
+
+
+def cancel_upload(upload_id: str, name: str):
+    os.remove(upload_path(upload_id, name))
+    _upload_hashes.pop(upload_id, None)
+    _upload_locks.pop(upload_id, None)
+
+
+def adopt_all():
+    """
+    Move all images stored before the blob store into it.
+    """
+    for filename in os.listdir(IMAGES_STORE):
+        if filename.endswith(".sif") and not filename.startswith("."):
+            try:
+                if os.stat(tag_path(filename[:-4])).st_nlink == 1:
+                    adopt(filename[:-4])
+            except OSError as e:
+                logger.error(f"Cannot move image {filename} to the blob store: {e}")
+
+
+def _entry(
+    name: str, digest: str, size: int, uploaded_at: float, metadata: dict | None
+) -> dict:
+    return {
+        "name": name,
+        "digest": digest,
+        "size": size,
+        "uploaded_at": uploaded_at,
+        "type": "apptainer" if metadata else "unknown",
+        "status": "available" if metadata else "invalid",
+        "architecture": metadata["architecture"] if metadata else None,
+        "sif": metadata,
+    }
+
+
+def _read_entry(name: str, digest: str, uploaded_at: float | None = None) -> dict:
+    path = tag_path(name)
+    st = os.stat(path)
+    try:
+        metadata = sif.read_metadata(path)
+    except Exception as e:
+        # A malformed image must not keep the catalog from loading.
+        logger.warning(f"Cannot read the SIF header of image {name}: {e}")
+        metadata = None
+    if uploaded_at is None:
+        uploaded_at = st.st_mtime
+    return _entry(name, digest, st.st_size, uploaded_at, metadata)
+
+
+def _update_etag():
+    global _catalog_etag
+    hash = hashlib.sha256()
+    for name in _names:
+        entry = _catalog[name]
+        hash.update(f"{name}\0{entry['digest']}\0{entry['uploaded_at']}\n".encode())
+    _catalog_etag = f'"{hash.hexdigest()[:32]}"'
+
+
+def _persist(entry: dict):
+    index.upsert_image(
+        entry["name"],
+        entry["digest"],
+        entry["size"],
+        entry["uploaded_at"],
+        entry["sif"],
+    )
+
+
+def _catalog_put(entry: dict):
+    with _catalog_lock:
+        _persist(entry)
+        if entry["name"] not in _catalog:
+            bisect.insort(_names, entry["name"])
+        _catalog[entry["name"]] = entry
+        _update_etag()
+
+
+def _catalog_remove(name: str):
+    with _catalog_lock:
+        index.delete_image(name)
+        if _catalog.pop(name, None) is not None:
+            del _names[bisect.bisect_left(_names, name)]
+            _update_etag()
+
+
+def catalog_get(name: str) -> dict | None:
+    """
+    Get the catalog entry of the image, which must not be modified.
+    """
+    return _catalog.get(name)
+
+
+def catalog_page(skip: int, limit: int) -> tuple[int, list[dict], str]:
+    """
+    Get the total number of images, the entries of the requested page and
+    the ETag of the catalog.
+    """
+    with _catalog_lock:
+        names = _names[skip : skip + limit]
+        return len(_names), [_catalog[name] for name in names], _catalog_etag
+
+
+def load_catalog():
+    """
+    Load the catalog from the index and update the entries of tags changed
+    or added outside of the service.
+    """
+    rows = {row[0]: row for row in index.load_images()}
+    tags = {
+        filename[:-4]
+        for filename in os.listdir(IMAGES_STORE)
+        if filename.endswith(".sif") and not filename.startswith(".")
+    }
+    with _catalog_lock:
+        _catalog.clear()
+        for name in tags:
+            digest = get_digest(tag_path(name)) or ""
+            row = rows.get(name)
+            if row is not None and row[1] == digest:
+                _catalog[name] = _entry(*row)
+                continue
+            try:
+                _catalog[name] = _read_entry(name, digest)
+            except OSError as e:
+                logger.error(f"Cannot read image {name}: {e}")
+                continue
+            _persist(_catalog[name])
+        for name in rows.keys() - _catalog.keys():
+            index.delete_image(name)
+        _names[:] = sorted(_catalog)
+        _update_etag()
+
+
+adopt_all()
+load_catalog()
@@ -0,0 +1,407 @@
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+INDEX_PATH = ".store/index.db"
+
+_local = threading.local()
+
+# Whether the store predates the index, checked before the first connection
+# creates the file, whichever module connects first.
+missing = not os.path.exists(INDEX_PATH)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    state TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+CREATE TABLE IF NOT EXISTS archives (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    atime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS archives_atime ON archives (atime);
+CREATE TABLE IF NOT EXISTS build_cache (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    atime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS build_cache_atime ON build_cache (atime);
+CREATE TABLE IF NOT EXISTS images (
+    name TEXT PRIMARY KEY,
+    digest TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    uploaded_at REAL NOT NULL,
+    metadata TEXT
+);
+CREATE TABLE IF NOT EXISTS pipelines (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at REAL NOT NULL,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS pipeline_jobs (
+    pipeline_id INTEGER NOT NULL,
+    job_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    needs TEXT NOT NULL,
+    PRIMARY KEY (pipeline_id, job_id)
+);
+"""
+
+# Columns added to the jobs table after its creation.
+JOB_COLUMNS = {
+    "exit_code": "INTEGER",
+    "queued_at": "REAL",
+    "started_at": "REAL",
+    "finished_at": "REAL",
+    "accessed_at": "REAL",
+    "size": "INTEGER",
+}
+
+
+def connect() -> sqlite3.Connection:
+    """
+    Get the index connection of the current thread.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        os.makedirs(os.path.dirname(INDEX_PATH), exist_ok=True)
+        conn = sqlite3.connect(INDEX_PATH, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+        for column, type in JOB_COLUMNS.items():
+            if column not in columns:
+                conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {type}")
+        _local.conn = conn
+    return conn
+
+
+@contextmanager
+def transaction():
+    conn = connect()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def upsert_job(job_id: int, state: str):
+    connect().execute(
+        "INSERT INTO jobs (id, state) VALUES (?, ?) "
+        "ON CONFLICT (id) DO UPDATE SET state = excluded.state",
+        (job_id, state),
+    )
+
+
+def upsert_jobs(rows: list[tuple[int, str]]):
+    with transaction() as conn:
+        conn.executemany(
+            "INSERT INTO jobs (id, state) VALUES (?, ?) "
+            "ON CONFLICT (id) DO UPDATE SET state = excluded.state",
+            rows,
+        )
+
+
+def delete_job(job_id: int):
+    connect().execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+
+def query_jobs(state: str, skip: int, limit: int) -> tuple[int, list[int]]:
+    """
+    Get the total number of jobs matching the state filter and the IDs of
+    the requested page. The filter matches the states starting with it, e.g.
+    "done" matches "done (cached)", as a range scan of the state index.
+    """
+    conn = connect()
+    where = ""
+    params: tuple = ()
+    if state:
+        state = state.lower()
+        where = "WHERE state >= ? AND state < ?"
+        params = (state, state[:-1] + chr(ord(state[-1]) + 1))
+    total = conn.execute(f"SELECT COUNT(*) FROM jobs {where}", params).fetchone()[0]
+    rows = conn.execute(
+        f"SELECT id FROM jobs {where} ORDER BY id LIMIT ? OFFSET ?",
+        params + (limit, skip),
+    ).fetchall()
+    return total, [row[0] for row in rows]
+
+
+def count_jobs() -> dict[str, int]:
+    """
+    Get the number of jobs in each state.
+    """
+    rows = connect().execute("SELECT state, COUNT(*) FROM jobs GROUP BY state")
+    return dict(rows.fetchall())
+
+
+def replace_jobs(rows: list[tuple[int, str]]):
+    """
+    Replace the job states and drop missing jobs in a single transaction.
+    Timestamps of the remaining jobs are kept.
+    """
+    with transaction() as conn:
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS present (id INTEGER PRIMARY KEY)")
+        conn.execute("DELETE FROM present")
+        conn.executemany("INSERT INTO present (id) VALUES (?)", [(r[0],) for r in rows])
+        conn.execute("DELETE FROM jobs WHERE id NOT IN (SELECT id FROM present)")
+        conn.executemany(
+            "INSERT INTO jobs (id, state) VALUES (?, ?) "
+            "ON CONFLICT (id) DO UPDATE SET state = excluded.state",
+            rows,
+        )
+
+
+def job_queued(job_id: int):
+    connect().execute(
+        "UPDATE jobs SET queued_at = ?, started_at = NULL, finished_at = NULL, "
+        "exit_code = NULL, size = NULL WHERE id = ?",
+        (time.time(), job_id),
+    )
+
+
+def job_started(job_id: int):
+    connect().execute(
+        "UPDATE jobs SET started_at = ? WHERE id = ?", (time.time(), job_id)
+    )
+
+
+def job_finished(job_id: int, exit_code: int):
+    connect().execute(
+        "UPDATE jobs SET finished_at = ?, exit_code = ? WHERE id = ?",
+        (time.time(), exit_code, job_id),
+    )
+
+
+def job_accessed(job_id: int):
+    connect().execute(
+        "UPDATE jobs SET accessed_at = ? WHERE id = ?", (time.time(), job_id)
+    )
+
+
+def set_job_sizes(rows: list[tuple[int, int]]):
+    """
+    Store the disk usage of (job ID, bytes) finished jobs.
+    """
+    with transaction() as conn:
+        conn.executemany(
+            "UPDATE jobs SET size = ? WHERE id = ?", [(s, i) for i, s in rows]
+        )
+
+
+def query_retention() -> list[tuple]:
+    """
+    Get the (ID, state, last change, last use, size) of every job, the last
+    change being the time the job finished or was queued.
+    """
+    rows = connect().execute(
+        "SELECT id, state, COALESCE(finished_at, queued_at), "
+        "COALESCE(accessed_at, finished_at, queued_at), size FROM jobs ORDER BY id"
+    )
+    return rows.fetchall()
+
+
+# Tables of cached files evicted in least recently used order.
+LRU_TABLES = ("archives", "build_cache")
+
+
+def touch_cached(table: str, path: str, size: int):
+    """
+    Register a cached path or mark it as recently used.
+    """
+    assert table in LRU_TABLES
+    connect().execute(
+        f"INSERT INTO {table} (path, size, atime) VALUES (?, ?, ?) "
+        "ON CONFLICT (path) DO UPDATE SET size = excluded.size, atime = excluded.atime",
+        (path, size, time.time()),
+    )
+
+
+def _prefix_pattern(prefix: str) -> str:
+    return prefix.replace("%", "\\%").replace("_", "\\_") + "/%"
+
+
+def move_cached(table: str, old_prefix: str, new_prefix: str):
+    """
+    Rename the cached paths under old_prefix, e.g. after their job moved.
+    """
+    assert table in LRU_TABLES
+    pattern = _prefix_pattern(old_prefix)
+    with transaction() as conn:
+        conn.execute(
+            f"UPDATE OR IGNORE {table} SET path = ? || substr(path, ?) "
+            "WHERE path LIKE ? ESCAPE '\\'",
+            (new_prefix, len(old_prefix) + 1, pattern),
+        )
+        conn.execute(f"DELETE FROM {table} WHERE path LIKE ? ESCAPE '\\'", (pattern,))
+
+
+def forget_cached(table: str, prefix: str):
+    """
+    Forget the cached paths under prefix, e.g. when their job is deleted.
+    """
+    assert table in LRU_TABLES
+    connect().execute(
+        f"DELETE FROM {table} WHERE path LIKE ? ESCAPE '\\'", (_prefix_pattern(prefix),)
+    )
+
+
+def evict_cached(table: str, max_bytes: int, keep: str) -> list[str]:
+    """
+    Forget the least recently used paths, except keep, until the total size
+    fits in max_bytes and return them.
+    """
+    assert table in LRU_TABLES
+    with transaction() as conn:
+        total = conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM {table}")
+        total = total.fetchone()[0]
+        evicted = []
+        if total > max_bytes:
+            rows = conn.execute(f"SELECT path, size FROM {table} ORDER BY atime")
+            for path, size in rows.fetchall():
+                if total <= max_bytes:
+                    break
+                if path == keep:
+                    continue
+                evicted.append(path)
+                total -= size
+            conn.executemany(
+                f"DELETE FROM {table} WHERE path = ?", [(path,) for path in evicted]
+            )
+    return evicted
+
+
+def load_images() -> list[tuple]:
+    """
+    Get the name, digest, size, upload time and SIF metadata of every image.
+    """
+    rows = (
+        connect()
+        .execute("SELECT name, digest, size, uploaded_at, metadata FROM images")
+        .fetchall()
+    )
+    return [(*row[:4], json.loads(row[4]) if row[4] else None) for row in rows]
+
+
+def upsert_image(
+    name: str, digest: str, size: int, uploaded_at: float, metadata: dict | None
+):
+    connect().execute(
+        "INSERT INTO images (name, digest, size, uploaded_at, metadata) "
+        "VALUES (?, ?, ?, ?, ?) ON CONFLICT (name) DO UPDATE SET "
+        "digest = excluded.digest, size = excluded.size, "
+        "uploaded_at = excluded.uploaded_at, metadata = excluded.metadata",
+        (name, digest, size, uploaded_at, json.dumps(metadata) if metadata else None),
+    )
+
+
+def delete_image(name: str):
+    connect().execute("DELETE FROM images WHERE name = ?", (name,))
+
+
+def create_pipeline(jobs: list[tuple[int, str, list[str]]]) -> int:
+    """
+    Register a pipeline of (job ID, name, needs) jobs and return its ID.
+    """
+    with transaction() as conn:
+        cursor = conn.execute(
+            "INSERT INTO pipelines (created_at) VALUES (?)", (time.time(),)
+        )
+        pipeline_id = cursor.lastrowid
+        conn.executemany(
+            "INSERT INTO pipeline_jobs (pipeline_id, job_id, name, needs) "
+            "VALUES (?, ?, ?, ?)",
+            [(pipeline_id, id, name, json.dumps(needs)) for id, name, needs in jobs],
+        )
+    return pipeline_id
+
+
+def set_pipeline_error(pipeline_id: int, error: str):
+    connect().execute(
+        "UPDATE pipelines SET error = ? WHERE id = ?", (error, pipeline_id)
+    )
+
+
+def jobs_in_states(states: tuple[str, ...]) -> list[int]:
+    marks = ", ".join("?" * len(states))
+    rows = connect().execute(
+        f"SELECT id FROM jobs WHERE state IN ({marks}) ORDER BY id", states
+    )
+    return [row[0] for row in rows]
+
+
+def active_pipeline_jobs(states: tuple[str, ...]) -> set[int]:
+    """
+    Get the IDs of the jobs of pipelines with a job in one of the states.
+    """
+    marks = ", ".join("?" * len(states))
+    rows = connect().execute(
+        "SELECT job_id FROM pipeline_jobs WHERE pipeline_id IN ("
+        "SELECT pj.pipeline_id FROM pipeline_jobs pj JOIN jobs j ON j.id = pj.job_id "
+        f"WHERE j.state IN ({marks}))",
+        states,
+    )
+    return {row[0] for row in rows}
+
+
+def query_pipelines(
+    skip: int = 0, limit: int = -1, pipeline_id: int | None = None
+) -> tuple[int, list[dict]]:
+    """
+    Get the total number of pipelines and the most recent ones, or only the
+    given one, with the state and timestamps of their jobs in one query.
+    """
+    conn = connect()
+    where = ""
+    params: tuple = ()
+    if pipeline_id is not None:
+        where = "WHERE id = ?"
+        params = (pipeline_id,)
+    total = conn.execute(f"SELECT COUNT(*) FROM pipelines {where}", params)
+    total = total.fetchone()[0]
+    rows = conn.execute(
+        "SELECT p.id, p.created_at, p.error, pj.job_id, pj.name, pj.needs, "
+        "j.state, j.exit_code, j.queued_at, j.started_at, j.finished_at "
+        f"FROM (SELECT * FROM pipelines {where} ORDER BY id DESC LIMIT ? OFFSET ?) p "
+        "JOIN pipeline_jobs pj ON pj.pipeline_id = p.id "
+        "LEFT JOIN jobs j ON j.id = pj.job_id "
+        "ORDER BY p.id DESC, pj.job_id",
+        params + (limit, skip),
+    )
+    pipelines: dict[int, dict] = {}
+    for row in rows:
+        pipeline = pipelines.setdefault(
+            row[0], {"id": row[0], "created_at": row[1], "error": row[2], "jobs": []}
+        )
+        pipeline["jobs"].append(
+            {
+                "id": row[3],
+                "name": row[4],
+                "needs": json.loads(row[5]),
+                "state": row[6] or "deleted",
+                "exit_code": row[7],
+                "queued_at": row[8],
+                "started_at": row[9],
+                "finished_at": row[10],
+            }
+        )
+    return total, list(pipelines.values())
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["rebuild"]:
+        print(f"usage: {sys.argv[0]} rebuild", file=sys.stderr)
+        sys.exit(2)
+    from utils.job import rebuild_index
+
+    print(f"Indexed {rebuild_index()} jobs")
@@ -1,29 +1,163 @@
 import os
+import shutil
 import subprocess
-import zipfile
 import hashlib
 import asyncio
-from io import BytesIO
+import fcntl
+import glob
+import json
 import logging
-from pydantic import BaseModel
+import mimetypes
+import uuid
+from contextlib import contextmanager
+from typing import AsyncIterator, Iterator
+from pydantic import BaseModel, Field
+
+from utils import (
+    archive,
+    events,
+    fs,
+    image as image_store,
+    index,
+    joblog,
+    metrics,
+    overlay,
+    pools,
+)
+
+try:
+    import magic
+except ImportError:
+    magic = None
 
 logger = logging.getLogger("uvicorn.error")
 
 JOBS_STORE = ".store/jobs"
-IMAGES_STORE = ".store/images"
+TRASH_STORE = ".store/trash"
 ROOT_MOUNT = "root"
 PROPERTIES_NAME = "properties"
+MAX_JOB_ID_NAME = "max_job_id.txt"
+LAYOUT_NAME = "layout"
+SHARD_SIZE = 100
 OVERLAY_DIR = "overlay"
+BASE_DIR = "base"
 LOG_FILE = "job.log"
 IMAGE_NAME = "image.sif"
 SCRIPT_NAME = "script"
+ARTIFACTS_NAME = "artifacts"
+INPUTS_NAME = "inputs.json"
+INPUTS_DIR = "inputs"
+INPUTS_MOUNT = "/inputs"
+MANIFEST_NAME = "artifacts.json"
 IMAGE_ATTR = "user.image"
+IMAGE_DIGEST_ATTR = "user.image_digest"
 EXIT_CODE_ATTR = "user.exit_code"
 STATE_ATTR = "user.state"
 HASH_ATTR = "user.hash"
+CPUS_ATTR = "user.cpus"
+MEMORY_ATTR = "user.memory"
+CACHE_ATTR = "user.cache"
+OVERLAY_ATTR = "user.overlay"
+ARTIFACTS_ATTR = "user.artifacts"
+ACTIVE_STATES = ("queued", "running")
+CACHED_STATE = "done (cached)"
+TERMINAL_STATES = ("done", CACHED_STATE, "failed", "skipped", "stopped", "deleted")
+ARTIFACT_CHUNK_SIZE = 1024 * 1024
+MAX_BATCH_SIZE = 1000
+MIME_BATCH_SIZE = 1000
+LOG_POLL_INTERVAL = 0.5
 
 os.makedirs(JOBS_STORE, exist_ok=True)
 
+# Jobs are stored in a fan-out layout, jobs/00/12/1234, with SHARD_SIZE
+# consecutive jobs per directory. Stores created before it have every job
+# directly in jobs/ and keep creating them there until they are migrated
+# with `python -m utils.migrate`. The layout file records the state of the
+# store: absent for a flat store, "migrating" while flat jobs remain, and
+# "sharded" once every job is sharded and flat paths are no longer checked.
+
+
+def read_layout() -> str:
+    try:
+        with open(f"{JOBS_STORE}/{LAYOUT_NAME}") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        if not any(name.isdigit() for name in os.listdir(JOBS_STORE)):
+            # New store.
+            write_layout("sharded")
+            return "sharded"
+        return "flat"
+
+
+def write_layout(layout: str):
+    global _layout
+    tmp = f"{JOBS_STORE}/{LAYOUT_NAME}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, "w") as f:
+        f.write(layout + "\n")
+    os.rename(tmp, f"{JOBS_STORE}/{LAYOUT_NAME}")
+    _layout = layout
+
+
+_layout = read_layout()
+
+
+def shard_dir(job_id: int) -> str:
+    # Two digits of the bucket per level, least significant last, with at
+    # least two levels: jobs/00/12 for bucket 12, jobs/01/23/45 for bucket
+    # 12345. Top level names always have two digits and deeper shards nest
+    # in the directory of their prefix, next to its jobs.
+    bucket = job_id // SHARD_SIZE
+    levels = [f"{bucket % 100:02d}"]
+    bucket //= 100
+    while True:
+        levels.append(f"{bucket % 100:02d}")
+        bucket //= 100
+        if not bucket:
+            break
+    return "/".join([JOBS_STORE, *reversed(levels)])
+
+
+def flat_dir(job_id: int) -> str:
+    return f"{JOBS_STORE}/{job_id}"
+
+
+def job_dir(job_id: int) -> str:
+    """
+    Get the directory of the job, which is flat until the store is migrated.
+    """
+    if _layout != "sharded":
+        path = flat_dir(job_id)
+        # Moved jobs leave a link at their flat path, resolved to the shard
+        # so that nothing started after the move depends on the link.
+        if not os.path.islink(path) and os.path.exists(f"{path}/{PROPERTIES_NAME}"):
+            return path
+    return f"{shard_dir(job_id)}/{job_id}"
+
+
+def iter_job_ids() -> Iterator[int]:
+    """
+    Get the IDs of the jobs in the store, flat or sharded.
+    """
+    for entry in os.scandir(JOBS_STORE):
+        if not entry.name.isdigit() or not entry.is_dir(follow_symlinks=False):
+            continue
+        if os.path.exists(f"{entry.path}/{PROPERTIES_NAME}"):
+            yield int(entry.name)
+        elif len(entry.name) == 2:
+            yield from _iter_shard(entry.path)
+
+
+def _iter_shard(path: str) -> Iterator[int]:
+    for entry in os.scandir(path):
+        if not entry.name.isdigit() or not entry.is_dir(follow_symlinks=False):
+            continue
+        if len(entry.name) == 2 and not os.path.exists(
+            f"{entry.path}/{PROPERTIES_NAME}"
+        ):
+            yield from _iter_shard(entry.path)
+        else:
+            yield int(entry.name)
+
 
 class Image(BaseModel):
     id: int
@@ -31,7 +165,14 @@ class Image(BaseModel):
     script: str
     exit_code: int
     image: str
+    image_digest: str = ""
     artifacts: list[str]
+    cpus: float | None = None
+    memory: int | None = None
+    cache: bool = False
+    overlay: str | None = None
+    inputs: dict[str, int] = Field(default_factory=dict)
+    queue_position: int | None = None
 
 
 class LaunchException(Exception):
@@ -49,46 +190,100 @@ class JobException(Exception):
 class ImageProperties(BaseModel):
     image: str
     artifacts: list[str] | None = None
+    cpus: float | None = Field(default=None, gt=0)
+    memory: int | None = Field(default=None, gt=0, description="Memory limit in MiB")
+    cache: bool = Field(
+        default=False, description="Reuse the result of an identical successful job"
+    )
+    overlay: str | None = Field(
+        default=None, description="Name of the overlay template the job starts from"
+    )
 
 
 class FileProperties(BaseModel):
     name: str
     size: str
     type: str
+    sha256: str | None = None
 
 
-def create_job() -> int:
-    max_job_id = 0
+@contextmanager
+def counter_lock() -> Iterator[int]:
+    """
+    Lock the job ID counter file with flock(2) and get its descriptor. Held
+    while jobs are created and while the layout of the store changes.
+    """
+    fd = os.open(f"{JOBS_STORE}/{MAX_JOB_ID_NAME}", os.O_RDWR | os.O_CREAT, 0o644)
     try:
-        with open(f"{JOBS_STORE}/max_job_id.txt", "r") as f:
-            max_job_id = int(f.read().strip())
-    except FileNotFoundError:
-        pass
-    except ValueError:
-        raise ValueError("Invalid job ID format in max_job_id.txt")
-    max_job_id += 1
-    with open(f"{JOBS_STORE}/max_job_id.txt", "w") as f:
-        f.write(str(max_job_id))
-    os.makedirs(f"{JOBS_STORE}/{max_job_id}", exist_ok=True)
-    properties = f"{JOBS_STORE}/{max_job_id}/{PROPERTIES_NAME}"
-    if not os.path.exists(properties):
-        with open(properties, "w") as f:
-            f.write("SEE EXTENDED ATTRIBUTES\n")
-    return max_job_id
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield fd
+    finally:
+        os.close(fd)
+
+
+def allocate_job_ids(fd: int, count: int) -> range:
+    """
+    Reserve count consecutive job IDs in the locked counter, so concurrent
+    requests and processes never get the same ID.
+    """
+    os.lseek(fd, 0, os.SEEK_SET)
+    content = os.read(fd, 64).decode().strip()
+    if content:
+        try:
+            max_job_id = int(content)
+        except ValueError:
+            raise ValueError(f"Invalid job ID format in {MAX_JOB_ID_NAME}")
+    else:
+        max_job_id = max(iter_job_ids(), default=0)
+    value = str(max_job_id + count).encode()
+    os.lseek(fd, 0, os.SEEK_SET)
+    os.ftruncate(fd, 0)
+    os.write(fd, value)
+    return range(max_job_id + 1, max_job_id + count + 1)
+
+
+def create_jobs(count: int) -> list[int]:
+    """
+    Create count jobs with consecutive IDs.
+    """
+    global _layout
+    with counter_lock() as fd:
+        ids = list(allocate_job_ids(fd, count))
+        # The layout only changes under the lock, see utils.migrate.
+        if _layout != "sharded":
+            _layout = read_layout()
+        for job_id in ids:
+            path = flat_dir(job_id) if _layout == "flat" else job_dir(job_id)
+            os.makedirs(path, exist_ok=True)
+            properties = f"{path}/{PROPERTIES_NAME}"
+            if not os.path.exists(properties):
+                with open(properties, "w") as f:
+                    f.write("SEE EXTENDED ATTRIBUTES\n")
+    index.upsert_jobs([(job_id, job_state(job_id)) for job_id in ids])
+    metrics.jobs_created.inc(count)
+    return ids
+
+
+def create_job() -> int:
+    return create_jobs(1)[0]
+
+
+def job_exists(job_id: int) -> bool:
+    return os.path.isdir(job_dir(job_id))
 
 
 def job_state(job_id: int) -> str:
     state = "not ready"
-    image_path = f"{JOBS_STORE}/{job_id}/{IMAGE_NAME}"
+    image_path = f"{job_dir(job_id)}/{IMAGE_NAME}"
     if not os.path.exists(image_path):
         return state
-    script_path = f"{JOBS_STORE}/{job_id}/{SCRIPT_NAME}"
+    script_path = f"{job_dir(job_id)}/{SCRIPT_NAME}"
     if not os.path.exists(script_path):
         return state
     state = "ready"
     try:
         state = os.getxattr(
-            f"{JOBS_STORE}/{job_id}/{PROPERTIES_NAME}",
+            f"{job_dir(job_id)}/{PROPERTIES_NAME}",
             STATE_ATTR,
             follow_symlinks=False,
         ).decode()
@@ -101,7 +296,7 @@ def job_from_id(job_id: int) -> Image | None:
     """
     Get job properties from the job ID.
     """
-    job_path = f"{JOBS_STORE}/{job_id}"
+    job_path = job_dir(job_id)
     if not os.path.exists(job_path):
         return None
     try:
@@ -110,18 +305,23 @@ def job_from_id(job_id: int) -> Image | None:
         ).decode()
     except OSError:
         image = ""
+    try:
+        image_digest = os.getxattr(
+            f"{job_path}/{PROPERTIES_NAME}", IMAGE_DIGEST_ATTR, follow_symlinks=False
+        ).decode()
+    except OSError:
+        image_digest = ""
 
     script = ""
     script_path = f"{job_path}/{SCRIPT_NAME}"
 
     properties_path = f"{job_path}/{PROPERTIES_NAME}"
-    try:
-        artifacts_raw = os.getxattr(
-            properties_path, "user.artifacts", follow_symlinks=False
-        ).decode()
-        artifacts = artifacts_raw.split(",")
-    except OSError:
-        artifacts = []
+    artifacts = artifact_specs(job_id)
+
+    cpus, memory = job_resources(job_id)
+    cache = job_cached(job_id)
+    overlay_name = job_overlay(job_id)
+    inputs = job_inputs(job_id)
 
     if not os.path.exists(script_path):
         return Image(
@@ -130,19 +330,19 @@ def job_from_id(job_id: int) -> Image | None:
             script="",
             exit_code=-1,
             image=image,
+            image_digest=image_digest,
             artifacts=artifacts,
+            cpus=cpus,
+            memory=memory,
+            cache=cache,
+            overlay=overlay_name,
+            inputs=inputs,
         )
     with open(script_path, "r") as f:
         script = f.read().strip()
 
     state = job_state(job_id)
-
-    try:
-        exit_code = int(
-            os.getxattr(properties_path, EXIT_CODE_ATTR, follow_symlinks=False).decode()
-        )
-    except OSError:
-        exit_code = -1
+    exit_code = job_exit_code(job_id)
 
     return Image(
         id=job_id,
@@ -150,42 +350,202 @@ def job_from_id(job_id: int) -> Image | None:
         script=script,
         exit_code=exit_code,
         image=image,
+        image_digest=image_digest,
         artifacts=artifacts,
+        cpus=cpus,
+        memory=memory,
+        cache=cache,
+        overlay=overlay_name,
+        inputs=inputs,
     )
 
 
+def job_resources(job_id: int) -> tuple[float | None, int | None]:
+    """
+    Get the CPU count and memory limit (MiB) requested by the job.
+    """
+    properties_path = f"{job_dir(job_id)}/{PROPERTIES_NAME}"
+    try:
+        cpus = float(
+            os.getxattr(properties_path, CPUS_ATTR, follow_symlinks=False).decode()
+        )
+    except OSError:
+        cpus = None
+    try:
+        memory = int(
+            os.getxattr(properties_path, MEMORY_ATTR, follow_symlinks=False).decode()
+        )
+    except OSError:
+        memory = None
+    return cpus, memory
+
+
+def job_cached(job_id: int) -> bool:
+    """
+    Check whether the job opted in to the build cache.
+    """
+    try:
+        os.getxattr(
+            f"{job_dir(job_id)}/{PROPERTIES_NAME}",
+            CACHE_ATTR,
+            follow_symlinks=False,
+        )
+        return True
+    except OSError:
+        return False
+
+
+def job_overlay(job_id: int) -> str | None:
+    """
+    Get the name of the overlay template the job starts from.
+    """
+    try:
+        return os.getxattr(
+            f"{job_dir(job_id)}/{PROPERTIES_NAME}",
+            OVERLAY_ATTR,
+            follow_symlinks=False,
+        ).decode()
+    except OSError:
+        return None
+
+
+def artifact_specs(job_id: int) -> list[str]:
+    """
+    Get the artifact paths, directories and glob patterns declared by the job.
+    """
+    job_path = job_dir(job_id)
+    try:
+        with open(f"{job_path}/{ARTIFACTS_NAME}", "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        pass
+    try:
+        # Jobs created before the artifacts file kept a comma-joined xattr.
+        return (
+            os.getxattr(
+                f"{job_path}/{PROPERTIES_NAME}", ARTIFACTS_ATTR, follow_symlinks=False
+            )
+            .decode()
+            .split(",")
+        )
+    except OSError:
+        return []
+
+
+def job_inputs(job_id: int) -> dict[str, int]:
+    """
+    Get the upstream jobs whose artifacts the job reads, by input name.
+    """
+    try:
+        with open(f"{job_dir(job_id)}/{INPUTS_NAME}", "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def set_inputs(job_id: int, inputs: dict[str, int]):
+    """
+    Expose the artifacts of the upstream jobs to the job at INPUTS_MOUNT/<name>
+    when it runs. Only the job IDs are recorded, whatever the artifact size.
+    """
+    job_path = job_dir(job_id)
+    if not os.path.exists(job_path):
+        raise JobException("Job not found")
+    for name, upstream in inputs.items():
+        if not name or "/" in name or ":" in name or "," in name or name in (".", ".."):
+            raise JobException(f"Invalid input name '{name}'")
+        if not os.path.exists(job_dir(upstream)):
+            raise JobException(f"Input job {upstream} not found")
+    inputs_path = f"{job_path}/{INPUTS_NAME}"
+    with open(f"{inputs_path}.tmp", "w") as f:
+        json.dump(inputs, f)
+    os.replace(f"{inputs_path}.tmp", inputs_path)
+
+
+def copy_inputs(job_id: int, link: bool = False) -> str:
+    """
+    Clone the input artifacts listed in the upstream manifests into the job
+    directory and return the directory. Files are reflinked where supported,
+    else hard linked if link is set, for backends mounting the directory
+    read-only, else copied, so the job cannot change the upstream artifacts.
+    """
+    inputs_path = f"{job_dir(job_id)}/{INPUTS_DIR}"
+    shutil.rmtree(inputs_path, ignore_errors=True)
+    os.makedirs(inputs_path)
+    for name, upstream in job_inputs(job_id).items():
+        os.makedirs(f"{inputs_path}/{name}")
+        try:
+            files = artifact_files(upstream)
+        except JobException:
+            continue
+        for path, artifact in files:
+            dst = os.path.join(inputs_path, name, artifact)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            fs.clone(path, dst, link=link)
+    return inputs_path
+
+
+def is_done(state: str) -> bool:
+    return state in ("done", CACHED_STATE)
+
+
 def update_job(job_id: int, props: ImageProperties):
-    job_path = f"{JOBS_STORE}/{job_id}"
+    job_path = job_dir(job_id)
     if not os.path.exists(job_path):
         raise JobException("Job not found")
 
-    image_path = os.path.abspath(f"{IMAGES_STORE}/{props.image}.sif")
-    if not os.path.exists(image_path):
-        raise JobException("Image not found")
+    try:
+        if props.overlay is not None and overlay.get_template(props.overlay) is None:
+            raise JobException("Overlay template not found")
+    except overlay.OverlayException as e:
+        raise JobException(e.message)
 
-    symlink_path = f"{job_path}/{IMAGE_NAME}"
-    if os.path.exists(symlink_path):
-        os.remove(symlink_path)
-    os.symlink(image_path, symlink_path)
+    try:
+        digest = image_store.pin(props.image, f"{job_path}/{IMAGE_NAME}")
+    except image_store.ImageException as e:
+        raise JobException(e.message)
 
     properties_path = f"{job_path}/{PROPERTIES_NAME}"
     os.setxattr(
         properties_path, IMAGE_ATTR, props.image.encode(), follow_symlinks=False
     )
-    if props.artifacts:
-        os.setxattr(
-            properties_path,
-            "user.artifacts",
-            ",".join(props.artifacts).encode(),
-            follow_symlinks=False,
-        )
+    os.setxattr(
+        properties_path, IMAGE_DIGEST_ATTR, digest.encode(), follow_symlinks=False
+    )
+    if props.artifacts is not None:
+        specs_path = f"{job_path}/{ARTIFACTS_NAME}"
+        with open(f"{specs_path}.tmp", "w") as f:
+            json.dump(props.artifacts, f)
+        os.replace(f"{specs_path}.tmp", specs_path)
+        try:
+            os.removexattr(properties_path, ARTIFACTS_ATTR, follow_symlinks=False)
+        except OSError:
+            pass
+    cache = "1" if props.cache else None
+    attrs = (
+        (CPUS_ATTR, props.cpus),
+        (MEMORY_ATTR, props.memory),
+        (CACHE_ATTR, cache),
+        (OVERLAY_ATTR, props.overlay),
+    )
+    for attr, value in attrs:
+        if value is not None:
+            os.setxattr(
+                properties_path, attr, str(value).encode(), follow_symlinks=False
+            )
+        else:
+            try:
+                os.removexattr(properties_path, attr, follow_symlinks=False)
+            except OSError:
+                pass
 
+    index_job(job_id)
     job = job_from_id(job_id)
     return job
 
 
 def put_script(job_id: int, script_content: bytes):
-    job_path = f"{JOBS_STORE}/{job_id}"
+    job_path = job_dir(job_id)
     if not os.path.exists(job_path):
         raise JobException("Job not found")
 
@@ -197,12 +557,13 @@ def put_script(job_id: int, script_content: bytes):
         os.setxattr(script_path, HASH_ATTR, hash.encode(), follow_symlinks=False)
 
     os.chmod(script_path, 0o755)
+    index_job(job_id)
 
     return job_from_id(job_id), hash
 
 
 def get_script_etag(job_id: int) -> str | None:
-    job_path = f"{JOBS_STORE}/{job_id}"
+    job_path = job_dir(job_id)
     if not os.path.exists(job_path):
         return None
 
@@ -219,7 +580,7 @@ def get_script_etag(job_id: int) -> str | None:
 
 
 def get_script(job_id: int) -> str:
-    job_path = f"{JOBS_STORE}/{job_id}"
+    job_path = job_dir(job_id)
     if not os.path.exists(job_path):
         raise JobException("Job not found")
 
@@ -231,77 +592,28 @@ def get_script(job_id: int) -> str:
         return f.read().strip()
 
 
-async def launch(job_id):
-    script_path = os.path.abspath(f"{JOBS_STORE}/{job_id}/{SCRIPT_NAME}")
-    if not os.path.exists(script_path):
-        raise LaunchException("Script not found")
-    image_path = os.path.abspath(f"{JOBS_STORE}/{job_id}/{IMAGE_NAME}")
-    if not os.path.exists(image_path):
-        raise LaunchException("Image not found")
-    overlay_path = os.path.abspath(f"{JOBS_STORE}/{job_id}/{OVERLAY_DIR}")
-    os.makedirs(overlay_path, exist_ok=True)
-
-    properties_path = os.path.abspath(f"{JOBS_STORE}/{job_id}/{PROPERTIES_NAME}")
-    root_mount = os.path.abspath(f"{JOBS_STORE}/{job_id}/{ROOT_MOUNT}")
-    os.makedirs(root_mount, exist_ok=True)
-
-    cmd = [
-        f"apptainer exec -C --fakeroot --bind {script_path} --bind {root_mount}:/root/ --overlay {overlay_path} {image_path} {script_path};",
-        f"setfattr --name {EXIT_CODE_ATTR} --value $? {properties_path};"
-        f"setfattr --name {STATE_ATTR} --value done {properties_path};",
-    ]
-
-    cmd = " ".join(cmd)
-    cmd = f"bash -c '{cmd}'"
-
-    logger.info(f"Launching job {job_id} with command: {cmd}")
-
-    log_file = os.path.abspath(f"{JOBS_STORE}/{job_id}/{LOG_FILE}")
-    log_f = open(log_file, "w")
-    process = await asyncio.create_subprocess_shell(
-        cmd,
-        stdout=log_f,
-        stderr=log_f,
-    )
-
-    return process, log_f
-
-
-async def wait(process, job_id, log) -> int:
-    """
-    Wait for the job to complete and return the exit code.
-    """
-    await process.communicate()
-    log.close()
+def job_exit_code(job_id: int) -> int:
+    properties_path = f"{job_dir(job_id)}/{PROPERTIES_NAME}"
     try:
-        exit_code = int(
-            os.getxattr(
-                f"{JOBS_STORE}/{job_id}/{PROPERTIES_NAME}",
-                EXIT_CODE_ATTR,
-                follow_symlinks=False,
-            ).decode()
+        return int(
+            os.getxattr(properties_path, EXIT_CODE_ATTR, follow_symlinks=False).decode()
         )
     except OSError:
-        exit_code = -1
-        pass
-    logger.info(f"Job completed with exit code: {exit_code}")
-    return exit_code
+        return -1
 
 
-async def launch_and_wait(job_id: int) -> int:
-    """
-    Launch the job script and wait for it to complete.
-    """
-    process, log = await launch(job_id)
-    exit_code = await wait(process, job_id, log)
-    return exit_code
+def set_exit_code(job_id: int, exit_code: int):
+    properties_path = f"{job_dir(job_id)}/{PROPERTIES_NAME}"
+    os.setxattr(
+        properties_path, EXIT_CODE_ATTR, str(exit_code).encode(), follow_symlinks=False
+    )
 
 
 def set_state(job_id: int, state: str):
     """
-    Set the job state to 'start' or 'done'.
+    Set the job state, e.g. 'queued', 'running' or 'stopped'.
     """
-    job_path = f"{JOBS_STORE}/{job_id}"
+    job_path = job_dir(job_id)
     if not os.path.exists(job_path):
         raise JobException("Job not found")
 
@@ -309,136 +621,321 @@ def set_state(job_id: int, state: str):
     if not os.path.exists(properties_path):
         raise JobException("Properties file not found")
 
-    os.setxattr(properties_path, STATE_ATTR, f"{state}ed".encode(), follow_symlinks=False)
+    os.setxattr(properties_path, STATE_ATTR, state.encode(), follow_symlinks=False)
+    index_job(job_id)
+    metrics.job_transitions.inc(state=state)
+    if state in TERMINAL_STATES:
+        events.publish("job", job_id, state, exit_code=job_exit_code(job_id))
+    else:
+        events.publish("job", job_id, state)
 
     return state
 
 
-def get_log(job_id: int) -> str:
+def log_size(job_id: int) -> int:
     """
-    Get the job log.
+    Get the current size of the job log in bytes.
     """
-    log_path = f"{JOBS_STORE}/{job_id}/{LOG_FILE}"
-    if not os.path.exists(log_path):
+    try:
+        with joblog.open_log(f"{job_dir(job_id)}/{LOG_FILE}") as log:
+            return log.size
+    except OSError:
         raise JobException("Log file not found")
 
-    with open(log_path, "r") as f:
-        return f.read()
+
+def iter_log(job_id: int, start: int = 0, end: int | None = None) -> Iterator[bytes]:
+    """
+    Read the job log from start to end (exclusive) chunk by chunk, raw or
+    decompressing only the blocks of the range.
+    """
+    with joblog.open_log(f"{job_dir(job_id)}/{LOG_FILE}") as log:
+        yield from log.read(start, end)
 
 
-def get_artifacts(job_id: int) -> list[FileProperties]:
-    artifacts_path = f"{JOBS_STORE}/{job_id}/{ROOT_MOUNT}"
+def log_tail_offset(job_id: int, lines: int) -> int:
+    """
+    Get the offset where the last lines of the job log start.
+    """
+    with joblog.open_log(f"{job_dir(job_id)}/{LOG_FILE}") as log:
+        return joblog.tail_offset(log, lines)
 
-    if not os.path.exists(artifacts_path):
-        raise JobException("Artifacts not found")
 
-    artifacts_raw = ""
+async def follow_log(job_id: int, start: int = 0) -> AsyncIterator[bytes]:
+    """
+    Stream the job log from start as it is written until the job finishes.
+    """
+    log_path = f"{await pools.store.run(job_dir, job_id)}/{LOG_FILE}"
+    offset = start
+    while True:
+        running = await pools.store.run(job_state, job_id) in ACTIVE_STATES
+        if await pools.store.run(joblog.exists, log_path):
+            async for chunk in pools.store.iterate(iter_log(job_id, offset)):
+                offset += len(chunk)
+                yield chunk
+        if not running:
+            return
+        await asyncio.sleep(LOG_POLL_INTERVAL)
+
+
+def mime_types(paths: list[str]) -> list[str]:
+    """
+    Detect the MIME types of the files in one pass, in-process with libmagic
+    when python-magic is installed, else with one file(1) call per
+    MIME_BATCH_SIZE files.
+    """
+    if magic is not None:
+        detector = magic.Magic(mime=True)
+        return [detector.from_file(path) for path in paths]
+    types = []
+    for i in range(0, len(paths), MIME_BATCH_SIZE):
+        batch = paths[i : i + MIME_BATCH_SIZE]
+        try:
+            output = subprocess.run(
+                ["file", "-b", "--mime-type", "--", *batch],
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout.splitlines()
+        except (OSError, subprocess.CalledProcessError):
+            output = []
+        if len(output) == len(batch):
+            types.extend(line.strip() for line in output)
+        else:
+            types.extend(
+                mimetypes.guess_type(path)[0] or "application/octet-stream"
+                for path in batch
+            )
+    return types
 
-    try:
-        artifacts_raw = os.getxattr(
-            f"{JOBS_STORE}/{job_id}/{PROPERTIES_NAME}",
-            "user.artifacts",
-            follow_symlinks=False,
-        ).decode()
-    except OSError:
-        raise JobException("No artifacts found")
 
-    artifacts = artifacts_raw.split(",")
+def file_sha256(path: str) -> str:
+    hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(ARTIFACT_CHUNK_SIZE):
+            hash.update(chunk)
+    return hash.hexdigest()
 
-    files = []
-    for artifact in artifacts:
-        artifact_path = os.path.abspath(os.path.join(artifacts_path, artifact))
-        if os.path.exists(artifact_path):
-            file_info = FileProperties(
-                name=artifact,
-                size=str(os.path.getsize(artifact_path)),
-                type=subprocess.getoutput(
-                    f"file -b --mime-type '{artifact_path}'"
-                ).strip(),
+
+def expand_artifacts(job_id: int) -> list[tuple[str, str]]:
+    """
+    Expand the artifact specs of the job into the (path, name) pairs of the
+    existing files. Directories include all files below them and patterns
+    are globs relative to the job root, with ** matching any depth.
+    """
+    root = f"{job_dir(job_id)}/{ROOT_MOUNT}"
+    if not os.path.exists(root):
+        raise JobException("Artifacts not found")
+    specs = artifact_specs(job_id)
+    if not specs:
+        raise JobException("No artifacts found")
+
+    real_root = os.path.realpath(root)
+    files: dict[str, str] = {}
+
+    def add(path: str):
+        real = os.path.realpath(path)
+        if os.path.commonpath([real, real_root]) != real_root:
+            return
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    add(os.path.join(dirpath, filename))
+        elif os.path.isfile(path):
+            files.setdefault(os.path.relpath(path, root), path)
+
+    for spec in specs:
+        if glob.has_magic(spec):
+            pattern = os.path.join(glob.escape(root), spec)
+            for path in sorted(glob.glob(pattern, recursive=True)):
+                add(path)
+        elif spec:
+            add(os.path.join(root, spec))
+    return [(path, name) for name, path in files.items()]
+
+
+def scan_artifacts(job_id: int) -> list[FileProperties]:
+    """
+    Get the size, MIME type and SHA-256 of the existing job artifacts.
+    """
+    files = expand_artifacts(job_id)
+    types = mime_types([path for path, _ in files])
+    artifacts = []
+    for (path, name), type in zip(files, types):
+        artifacts.append(
+            FileProperties(
+                name=name,
+                size=str(os.path.getsize(path)),
+                type=type,
+                sha256=file_sha256(path),
             )
-            files.append(file_info)
+        )
+    return artifacts
 
-    return files
 
+def write_manifest(job_id: int) -> list[FileProperties]:
+    """
+    Scan the artifacts of a finished job and store them in its manifest.
+    """
+    artifacts = scan_artifacts(job_id)
+    manifest_path = f"{job_dir(job_id)}/{MANIFEST_NAME}"
+    tmp_path = f"{manifest_path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump([artifact.model_dump() for artifact in artifacts], f)
+    os.replace(tmp_path, manifest_path)
+    return artifacts
 
-def get_artifacts_raw(job_id: int) -> BytesIO:
-    artifacts_path = f"{JOBS_STORE}/{job_id}/{ROOT_MOUNT}"
-    if not os.path.exists(artifacts_path):
-        raise JobException("Artifacts not found")
 
-    artifacts_raw = ""
+def discard_manifest(job_id: int):
     try:
-        artifacts_raw = os.getxattr(
-            f"{JOBS_STORE}/{job_id}/{PROPERTIES_NAME}",
-            "user.artifacts",
-            follow_symlinks=False,
-        ).decode()
-    except OSError:
-        raise JobException("No artifacts found")
+        os.remove(f"{job_dir(job_id)}/{MANIFEST_NAME}")
+    except FileNotFoundError:
+        pass
 
-    artifacts = artifacts_raw.split(",")
 
-    zip_buffer = BytesIO()
-    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
-        for artifact in artifacts:
-            artifact_path = os.path.join(artifacts_path, artifact)
-            if os.path.exists(artifact_path):
-                zip_file.write(artifact_path, arcname=artifact)
+def read_manifest(job_id: int) -> list[FileProperties] | None:
+    """
+    Get the artifact manifest of a finished job, written on completion or
+    on the first request. None while the job is queued or running.
+    """
+    state = job_state(job_id)
+    if not is_done(state) and state not in ("failed", "stopped"):
+        return None
+    manifest_path = f"{job_dir(job_id)}/{MANIFEST_NAME}"
+    try:
+        with open(manifest_path, "r") as f:
+            return [FileProperties(**artifact) for artifact in json.load(f)]
+    except (OSError, ValueError):
+        pass
+    return write_manifest(job_id)
+
+
+def get_artifacts(job_id: int) -> list[FileProperties]:
+    """
+    Get the job artifacts from the manifest of a finished job, or scan the
+    artifacts of an active job.
+    """
+    artifacts = read_manifest(job_id)
+    if artifacts is None:
+        return scan_artifacts(job_id)
+    return artifacts
+
 
-    zip_buffer.seek(0)
-    return zip_buffer
+def artifact_files(job_id: int) -> list[tuple[str, str]]:
+    """
+    Get the (path, name) pairs of the job artifacts.
+    """
+    artifacts = read_manifest(job_id)
+    if artifacts is None:
+        return expand_artifacts(job_id)
+    root = f"{job_dir(job_id)}/{ROOT_MOUNT}"
+    return [
+        (os.path.join(root, artifact.name), artifact.name) for artifact in artifacts
+    ]
+
+
+def _archive_key(artifacts: list[FileProperties], fmt: str) -> str:
+    key = hashlib.sha256(fmt.encode())
+    for artifact in artifacts:
+        key.update(f"\0{artifact.name}\0{artifact.sha256}".encode())
+    return key.hexdigest()
 
 
-def get_jobs(state: str) -> list[Image]:
+def artifacts_key(job_id: int, fmt: str) -> str:
+    """
+    Get the key of the artifacts archive of a finished job without building
+    it. The key hashes the manifest, so the files are not stat'ed again.
+    """
+    artifacts = read_manifest(job_id)
+    if artifacts is None:
+        raise JobException("Job is not finished")
+    return _archive_key(artifacts, fmt)
+
+
+def artifacts_archive(job_id: int, fmt: str) -> tuple[str, str]:
+    """
+    Get the path and key of the cached artifacts archive of a finished job,
+    building it on a miss.
+    """
+    artifacts = read_manifest(job_id)
+    if artifacts is None:
+        raise JobException("Job is not finished")
+    root = f"{job_dir(job_id)}/{ROOT_MOUNT}"
+    files = [(os.path.join(root, a.name), a.name) for a in artifacts]
+    key = _archive_key(artifacts, fmt)
+    with metrics.span("archive"):
+        return archive.cached_archive(job_dir(job_id), files, fmt, key)
+
+
+def get_jobs(state: str, skip: int, limit: int) -> tuple[int, list[Image]]:
+    """
+    Get the total number of jobs matching the state and the requested page.
+    """
+    with metrics.span("index"):
+        total, ids = index.query_jobs(state, skip, limit)
     jobs = []
-    for job_id in os.listdir(JOBS_STORE):
-        if job_id.isdigit():
-            job = job_from_id(int(job_id))
+    with metrics.span("load"):
+        for job_id in ids:
+            job = job_from_id(job_id)
             if job:
-                if state == "" or state.lower() in job.state:
-                    jobs.append(job)
-    return jobs
+                jobs.append(job)
+    return total, jobs
+
+
+def index_job(job_id: int):
+    """
+    Refresh the job entry in the job index.
+    """
+    if job_exists(job_id):
+        index.upsert_job(job_id, job_state(job_id))
+    else:
+        index.delete_job(job_id)
 
 
-def cp_artifacts(src_job: int, dst_job: int):
+def delete_job(job_id: int) -> int:
     """
-    Copy an artifact from the job's root mount to the current directory.
+    Remove the job from the store and the index and return the bytes freed.
+    Files of the job hard linked elsewhere (images, build cache, artifacts
+    copied to other jobs) are only unlinked from the job and stay intact.
     """
-    src_job_path = f"{JOBS_STORE}/{src_job}"
-    if not os.path.exists(src_job_path):
+    job_path = job_dir(job_id)
+    if not job_exists(job_id):
         raise JobException("Job not found")
+    size = fs.freed_size(job_path)
+    # Moved out of the store first, so the job disappears at once.
+    os.makedirs(TRASH_STORE, exist_ok=True)
+    trash = f"{TRASH_STORE}/{job_id}.{uuid.uuid4().hex}"
+    os.rename(job_path, trash)
+    index.delete_job(job_id)
+    # The cached archives are removed with the job.
+    index.forget_cached("archives", f"{job_path}/{archive.CACHE_DIR}")
+    events.publish("job", job_id, "deleted")
+    shutil.rmtree(trash, ignore_errors=True)
+    return size
+
+
+def drop_overlay(job_id: int) -> int:
+    """
+    Remove the overlay and template snapshot of a finished job, keeping its
+    root and artifacts, and return the bytes freed.
+    """
+    size = 0
+    for name in (OVERLAY_DIR, BASE_DIR):
+        path = f"{job_dir(job_id)}/{name}"
+        if os.path.isdir(path):
+            size += fs.freed_size(path)
+            shutil.rmtree(path, ignore_errors=True)
+    return size
 
-    src_artifact_path = f"{src_job_path}/{ROOT_MOUNT}"
-    if not os.path.exists(src_artifact_path):
-        raise JobException("Artifacts not found")
 
-    dst_job_path = f"{JOBS_STORE}/{dst_job}"
-    if not os.path.exists(dst_job_path):
-        raise JobException("Destination job not found")
+def rebuild_index() -> int:
+    """
+    Regenerate the job index from the jobs in the store.
+    """
+    rows = [(job_id, job_state(job_id)) for job_id in iter_job_ids()]
+    index.replace_jobs(rows)
+    return len(rows)
 
-    dst_artifact_path = f"{dst_job_path}/{ROOT_MOUNT}"
-    os.makedirs(dst_artifact_path, exist_ok=True)
-    artifacts_raw = ""
-    try:
-        artifacts_raw = os.getxattr(
-            f"{src_job_path}/{PROPERTIES_NAME}",
-            "user.artifacts",
-            follow_symlinks=False,
-        ).decode()
-    except OSError:
-        raise JobException("No artifacts found")
 
-    artifacts = artifacts_raw.split(",")
-    for artifact in artifacts:
-        src_file_path = os.path.join(src_artifact_path, artifact)
-        if os.path.exists(src_file_path):
-            dst_file_path = os.path.join(dst_artifact_path, artifact)
-            if not os.path.exists(dst_file_path):
-                os.makedirs(os.path.dirname(dst_file_path), exist_ok=True)
-                os.link(src_file_path, dst_file_path)
-            else:
-                raise JobException(
-                    f"Artifact {artifact} already exists in destination job"
-                )
-        else:
-            raise JobException(f"Artifact {artifact} not found in source job")
+if index.missing:
+    rebuild_index()
@@ -0,0 +1,218 @@
+import gzip
+import json
+import os
+import uuid
+from typing import Iterator
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+LOG_HEAD_SIZE = int(os.environ.get("RES_LOG_HEAD_SIZE", 4 * 1024**2))
+LOG_TAIL_SIZE = int(os.environ.get("RES_LOG_TAIL_SIZE", 4 * 1024**2))
+BLOCK_SIZE = 128 * 1024
+CHUNK_SIZE = 64 * 1024
+INDEX_SUFFIX = ".idx"
+CODECS = {"zstd": ".zst", "gzip": ".gz"}
+CODEC = "zstd" if zstandard is not None else "gzip"
+
+# Job logs are written raw while the job runs, keeping at most the first
+# LOG_HEAD_SIZE and the last LOG_TAIL_SIZE bytes of the output. Finished
+# logs are compressed in independent blocks of BLOCK_SIZE bytes, with an
+# index of the compressed offsets of the blocks, so that ranges and tails
+# are read by decompressing only the blocks they cover. Gzip blocks are
+# gzip members, so the compressed log is also a valid gzip file.
+
+
+class LogWriter:
+    """
+    Write the output of a job to its log. Once the output exceeds the head
+    and the tail size, the last tail size bytes are kept in memory and the
+    log is cut after the head when it is closed, with a line counting the
+    dropped bytes. Readers following the log may see the end of the log
+    replaced then.
+    """
+
+    def __init__(
+        self, path: str, head_size: int = LOG_HEAD_SIZE, tail_size: int = LOG_TAIL_SIZE
+    ):
+        discard(path)
+        self.path = path
+        self.head_size = head_size
+        self.tail_size = tail_size
+        self.file = open(path, "wb")
+        self.written = 0
+        self.total = 0
+        self.tail = bytearray()
+
+    @property
+    def truncated(self) -> bool:
+        return self.total > self.head_size + self.tail_size
+
+    def write(self, data: bytes):
+        self.total += len(data)
+        room = self.head_size + self.tail_size - self.written
+        if room > 0:
+            self.file.write(data[:room])
+            self.file.flush()
+            self.written += min(room, len(data))
+        if self.total > self.head_size:
+            self.tail += data[-self.tail_size :]
+            del self.tail[: -self.tail_size]
+
+    def close(self):
+        if self.truncated:
+            dropped = self.total - self.head_size - len(self.tail)
+            self.file.truncate(self.head_size)
+            self.file.seek(self.head_size)
+            self.file.write(f"\n[... {dropped} bytes of output dropped ...]\n".encode())
+            self.file.write(self.tail)
+        self.file.close()
+
+
+def files(path: str) -> list[str]:
+    """
+    Get the existing files of the log, raw or compressed with its index.
+    """
+    candidates = [path, path + INDEX_SUFFIX] + [path + s for s in CODECS.values()]
+    return [p for p in candidates if os.path.exists(p)]
+
+
+def exists(path: str) -> bool:
+    return bool(files(path))
+
+
+def discard(path: str):
+    for p in files(path):
+        os.remove(p)
+
+
+def _compress_block(codec: str, data: bytes) -> bytes:
+    if codec == "zstd":
+        return zstandard.ZstdCompressor().compress(data)
+    return gzip.compress(data, mtime=0)
+
+
+def _decompress_block(codec: str, data: bytes) -> bytes:
+    if codec == "zstd":
+        if zstandard is None:
+            raise OSError("Log is compressed with zstd, which is not installed")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+def compress(path: str, codec: str = CODEC) -> int:
+    """
+    Replace the raw log by its compressed blocks and index, and return the
+    compressed size.
+    """
+    compressed_path = path + CODECS[codec]
+    tmp = f"{compressed_path}.{uuid.uuid4().hex}.tmp"
+    offsets = [0]
+    size = 0
+    try:
+        with open(path, "rb") as src, open(tmp, "wb") as dst:
+            while block := src.read(BLOCK_SIZE):
+                dst.write(_compress_block(codec, block))
+                offsets.append(dst.tell())
+                size += len(block)
+        os.rename(tmp, compressed_path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    index = {"codec": codec, "size": size, "block_size": BLOCK_SIZE, "offsets": offsets}
+    tmp = f"{path}{INDEX_SUFFIX}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(index, f)
+    os.rename(tmp, path + INDEX_SUFFIX)
+    os.remove(path)
+    return offsets[-1]
+
+
+class RawLog:
+    block_size = CHUNK_SIZE
+
+    def __init__(self, path: str):
+        self.file = open(path, "rb")
+        self.size = os.fstat(self.file.fileno()).st_size
+
+    def read(self, start: int = 0, end: int | None = None) -> Iterator[bytes]:
+        self.file.seek(start)
+        remaining = -1 if end is None else end - start
+        while remaining != 0:
+            size = CHUNK_SIZE if remaining < 0 else min(CHUNK_SIZE, remaining)
+            chunk = self.file.read(size)
+            if not chunk:
+                break
+            if remaining > 0:
+                remaining -= len(chunk)
+            yield chunk
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CompressedLog(RawLog):
+    def __init__(self, path: str):
+        with open(path + INDEX_SUFFIX) as f:
+            index = json.load(f)
+        self.codec = index["codec"]
+        self.size = index["size"]
+        self.block_size = index["block_size"]
+        self.offsets = index["offsets"]
+        self.file = open(path + CODECS[self.codec], "rb")
+
+    def block(self, i: int) -> bytes:
+        self.file.seek(self.offsets[i])
+        data = self.file.read(self.offsets[i + 1] - self.offsets[i])
+        return _decompress_block(self.codec, data)
+
+    def read(self, start: int = 0, end: int | None = None) -> Iterator[bytes]:
+        end = self.size if end is None else min(end, self.size)
+        for i in range(start // self.block_size, -(-end // self.block_size)):
+            block_start = i * self.block_size
+            block = self.block(i)
+            yield block[max(start - block_start, 0) : end - block_start]
+
+
+def open_log(path: str) -> RawLog:
+    """
+    Open the compressed log if it is indexed, else the raw log. Raises
+    FileNotFoundError when there is no log.
+    """
+    for _ in range(2):
+        if os.path.exists(path + INDEX_SUFFIX):
+            return CompressedLog(path)
+        try:
+            return RawLog(path)
+        except FileNotFoundError:
+            # Compressed since the index was checked.
+            continue
+    raise FileNotFoundError(path)
+
+
+def tail_offset(log: RawLog, lines: int) -> int:
+    """
+    Get the offset where the last lines of the log start.
+    """
+    pos = log.size
+    if pos > 0 and b"".join(log.read(pos - 1, pos)) == b"\n":
+        pos -= 1
+    count = 0
+    while pos > 0:
+        step = pos - (pos - 1) // log.block_size * log.block_size
+        pos -= step
+        block = b"".join(log.read(pos, pos + step))
+        i = len(block)
+        while (i := block.rfind(b"\n", 0, i)) >= 0:
+            count += 1
+            if count == lines:
+                return pos + i + 1
+    return 0
@@ -0,0 +1,320 @@
+import bisect
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator
+
+# Metrics in the Prometheus text exposition format, without a client library.
+# Each metric keeps its samples by label values; gauges may instead be read
+# from a callback when the metrics are rendered.
+
+DISK_USAGE_INTERVAL = float(os.environ.get("RES_METRICS_DISK_INTERVAL", "60"))
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+JOB_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 4 * 3600, 12 * 3600)
+SIZE_BUCKETS = tuple(1024 * 4**i for i in range(12))
+
+_lock = threading.Lock()
+_registry: list["Metric"] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values: dict[tuple, object] = {}
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels[name] for name in self.labels)
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> Iterator[str]:
+        with _lock:
+            values = list(self.values.items())
+        for key, value in values:
+            labels = _format_labels(self.labels, key)
+            yield f"{self.name}{labels} {_format_value(value)}"
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Iterable[str] = (),
+        callback: Callable[[], dict[tuple, float]] | None = None,
+    ):
+        super().__init__(name, help, labels)
+        self.callback = callback
+
+    def set(self, value: float, **labels):
+        with _lock:
+            self.values[self._key(labels)] = value
+
+    def samples(self) -> Iterator[str]:
+        if self.callback is not None:
+            values = list(self.callback().items())
+        else:
+            with _lock:
+                values = list(self.values.items())
+        for key, value in values:
+            labels = _format_labels(self.labels, key)
+            yield f"{self.name}{labels} {_format_value(value)}"
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Iterable[str] = (),
+        buckets: tuple[float, ...] = DURATION_BUCKETS,
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with _lock:
+            if key not in self.values:
+                self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts, _, _ = sample = self.values[key]
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(counts):
+                counts[i] += 1
+            sample[1] += value
+            sample[2] += 1
+
+    def samples(self) -> Iterator[str]:
+        with _lock:
+            values = [(k, list(v[0]), v[1], v[2]) for k, v in self.values.items()]
+        for key, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                le = f'le="{_format_value(float(bound))}"'
+                labels = _format_labels(self.labels, key, le)
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labels, key, 'le="+Inf"')
+            yield f"{self.name}_bucket{labels} {count}"
+            labels = _format_labels(self.labels, key)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {count}"
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+
+def disk_usage(path: str) -> int:
+    """
+    Get the size in bytes of the regular files under path, counting hard
+    linked files once.
+    """
+    size = 0
+    seen = set()
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                st = os.lstat(os.path.join(dirpath, filename))
+            except OSError:
+                continue
+            if st.st_nlink > 1:
+                if (st.st_dev, st.st_ino) in seen:
+                    continue
+                seen.add((st.st_dev, st.st_ino))
+            size += st.st_blocks * 512
+    return size
+
+
+class CachedValue:
+    """
+    Value of an expensive callback, recomputed at most every interval seconds.
+    """
+
+    def __init__(self, callback: Callable[[], object], interval: float):
+        self.callback = callback
+        self.interval = interval
+        self.value = None
+        self.updated = float("-inf")
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            if time.monotonic() - self.updated >= self.interval:
+                self.value = self.callback()
+                self.updated = time.monotonic()
+            return self.value
+
+
+# Server-Timing spans of the current request, None outside of requests.
+_spans: contextvars.ContextVar[list | None] = contextvars.ContextVar(
+    "spans", default=None
+)
+
+
+@contextmanager
+def span(name: str):
+    """
+    Time a block and report it in the Server-Timing header of the request.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        spans = _spans.get()
+        if spans is not None:
+            spans.append((name, time.perf_counter() - start))
+
+
+def count_bytes(chunks: Iterable[bytes], kind: str) -> Iterator[bytes]:
+    """
+    Pass the chunks through, counting them in res_bytes_streamed_total.
+    """
+    for chunk in chunks:
+        bytes_streamed.inc(len(chunk), kind=kind)
+        yield chunk
+
+
+async def count_bytes_async(chunks, kind: str):
+    async for chunk in chunks:
+        bytes_streamed.inc(len(chunk), kind=kind)
+        yield chunk
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware observing the latency of every route and adding a
+    Server-Timing header with the spans recorded before the response starts.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        spans: list[tuple[str, float]] = []
+        token = _spans.set(spans)
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                total = time.perf_counter() - start
+                timing = [f"{n};dur={d * 1000:.3f}" for n, d in spans]
+                timing.append(f"total;dur={total * 1000:.3f}")
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", ", ".join(timing).encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _spans.reset(token)
+            route = scope.get("route")
+            path = getattr(route, "path", "unmatched")
+            request_duration.observe(
+                time.perf_counter() - start,
+                method=scope["method"],
+                route=path,
+                status=str(status),
+            )
+
+
+request_duration = Histogram(
+    "res_http_request_duration_seconds",
+    "HTTP request latency by route",
+    ("method", "route", "status"),
+)
+bytes_streamed = Counter(
+    "res_bytes_streamed_total",
+    "Bytes of images, artifacts and logs sent or received",
+    ("kind",),
+)
+jobs_created = Counter("res_jobs_created_total", "Jobs created")
+job_transitions = Counter(
+    "res_job_transitions_total", "Job state changes by new state", ("state",)
+)
+jobs_completed = Counter(
+    "res_jobs_completed_total", "Jobs finished by the scheduler", ("result",)
+)
+job_queue_seconds = Histogram(
+    "res_job_queue_seconds",
+    "Time jobs waited in the queue",
+    buckets=JOB_BUCKETS,
+)
+job_duration_seconds = Histogram(
+    "res_job_duration_seconds",
+    "Run time of finished jobs",
+    ("result",),
+    buckets=JOB_BUCKETS,
+)
+job_log_bytes = Histogram(
+    "res_job_log_bytes",
+    "Log size of finished jobs",
+    buckets=SIZE_BUCKETS,
+)
+jobs_reaped = Counter(
+    "res_gc_jobs_deleted_total", "Jobs deleted by the reaper by policy", ("reason",)
+)
+reclaimed_bytes = Counter(
+    "res_gc_reclaimed_bytes_total",
+    "Bytes freed by deleted jobs and dropped overlays",
+    ("reason",),
+)
+events_published = Counter(
+    "res_events_published_total", "Job and pipeline state events", ("type",)
+)
+pool_wait_seconds = Histogram(
+    "res_pool_wait_seconds",
+    "Time calls waited for a thread of the I/O thread pools",
+    ("pool",),
+)
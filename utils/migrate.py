@@ -0,0 +1,125 @@
+"""
+Migrate a flat job store to the sharded layout while the service runs.
+
+    python -m utils.migrate [--wait SECONDS]
+
+Jobs are moved one by one with a rename, leaving a symbolic link at the
+old path for processes that resolved it just before. Queued and running
+jobs are moved once they finish. The links are removed when every job is
+sharded and no longer queued or running.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import utils.job as jobs
+from utils import archive, index
+
+
+def flat_job_ids() -> list[int]:
+    """
+    Get the IDs of the jobs still stored directly in the store.
+    """
+    ids = []
+    for entry in os.scandir(jobs.JOBS_STORE):
+        if entry.name.isdigit() and entry.is_dir(follow_symlinks=False):
+            if os.path.exists(f"{entry.path}/{jobs.PROPERTIES_NAME}"):
+                ids.append(int(entry.name))
+    return sorted(ids)
+
+
+def move_job(job_id: int, link: bool = True):
+    src = jobs.flat_dir(job_id)
+    dst = f"{jobs.shard_dir(job_id)}/{job_id}"
+    os.makedirs(jobs.shard_dir(job_id), exist_ok=True)
+    os.rename(src, dst)
+    if link:
+        os.symlink(os.path.relpath(dst, jobs.JOBS_STORE), src)
+    index.move_cached(
+        "archives", f"{src}/{archive.CACHE_DIR}", f"{dst}/{archive.CACHE_DIR}"
+    )
+
+
+def migrate(wait: float = 5, log=print) -> int:
+    """
+    Move every flat job to its shard and return the number of moved jobs.
+    """
+    moved = []
+    with jobs.counter_lock():
+        # Shard directories have two digit names, which jobs 10 to 99 of a
+        # flat store also have, so these move before any job is created in
+        # a shard. They are not linked, their old paths are shards now.
+        if jobs.read_layout() == "flat":
+            small = [job_id for job_id in flat_job_ids() if job_id < jobs.SHARD_SIZE]
+            active = [i for i in small if jobs.job_state(i) in jobs.ACTIVE_STATES]
+            if active:
+                raise RuntimeError(f"Jobs {active} must finish before the migration")
+            for job_id in small:
+                move_job(job_id, link=False)
+            jobs.write_layout("migrating")
+            log(f"Moved {len(small)} jobs, new jobs are created in shards")
+
+    while remaining := flat_job_ids():
+        waiting = []
+        for job_id in remaining:
+            if jobs.job_state(job_id) in jobs.ACTIVE_STATES:
+                waiting.append(job_id)
+                continue
+            move_job(job_id)
+            moved.append(job_id)
+            if len(moved) % 1000 == 0:
+                log(f"Moved {len(moved)} jobs")
+        if waiting:
+            log(f"Waiting for {len(waiting)} queued or running jobs")
+            time.sleep(wait)
+
+    with jobs.counter_lock():
+        jobs.write_layout("sharded")
+    # Processes started before the migration resolve flat paths until the
+    # links are gone, after which they find the jobs in their shards. A job
+    # restarted just before its move keeps its flat path while it runs, so
+    # its link stays until it finishes.
+    links = moved
+    while links:
+        waiting = []
+        for job_id in links:
+            if jobs.job_state(job_id) in jobs.ACTIVE_STATES:
+                waiting.append(job_id)
+                continue
+            path = jobs.flat_dir(job_id)
+            if os.path.islink(path):
+                os.remove(path)
+                dst = f"{jobs.shard_dir(job_id)}/{job_id}"
+                index.move_cached(
+                    "archives",
+                    f"{path}/{archive.CACHE_DIR}",
+                    f"{dst}/{archive.CACHE_DIR}",
+                )
+        links = waiting
+        if waiting:
+            log(f"Waiting for {len(waiting)} queued or running jobs to unlink")
+            time.sleep(wait)
+    log(f"Moved {len(moved)} jobs, the store is sharded")
+    return len(moved)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--wait",
+        type=float,
+        default=5,
+        help="Seconds between checks of the jobs still queued or running",
+    )
+    args = parser.parse_args()
+    try:
+        migrate(args.wait)
+    except RuntimeError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import uuid
+
+from pydantic import BaseModel
+
+from utils import fs, image as image_store, joblog, pools
+
+logger = logging.getLogger("uvicorn.error")
+
+OVERLAYS_STORE = ".store/overlays"
+PROPERTIES_NAME = "properties"
+OVERLAY_DIR = "overlay"
+IMAGE_NAME = "image.sif"
+SCRIPT_NAME = "script"
+LOG_FILE = "build.log"
+IMAGE_ATTR = "user.image"
+IMAGE_DIGEST_ATTR = "user.image_digest"
+HASH_ATTR = "user.hash"
+STATE_ATTR = "user.state"
+EXIT_CODE_ATTR = "user.exit_code"
+
+os.makedirs(OVERLAYS_STORE, exist_ok=True)
+
+# A template (OVERLAYS_STORE/<name>) is an overlay directory prepared once by
+# running a setup script in an image. Jobs snapshot it and mount the snapshot
+# read-only below their own empty writable overlay, so a rebuilt or deleted
+# template never changes a job and a job never changes the template.
+
+# Running template builds, keyed by template name.
+_builds: dict[str, asyncio.Task] = {}
+# Held while a template is defined and its build started, so that two
+# definitions of a template cannot both start a build.
+define_lock = asyncio.Lock()
+
+
+class OverlayException(Exception):
+    def __init__(self, message: str):
+        super().__init__(message)
+        self.message = message
+
+
+class OverlayDefinition(BaseModel):
+    image: str
+    script: list[str]
+
+
+class OverlayTemplate(BaseModel):
+    name: str
+    image: str
+    image_digest: str
+    script: str
+    state: str
+    exit_code: int | None = None
+
+
+def template_path(name: str) -> str:
+    if not name or "/" in name or name.startswith("."):
+        raise OverlayException("Invalid overlay template name")
+    return f"{OVERLAYS_STORE}/{name}"
+
+
+def _get_attr(path: str, attr: str) -> str | None:
+    try:
+        return os.getxattr(path, attr, follow_symlinks=False).decode()
+    except OSError:
+        return None
+
+
+def _set_attr(path: str, attr: str, value: str):
+    os.setxattr(path, attr, value.encode(), follow_symlinks=False)
+
+
+def get_template(name: str) -> OverlayTemplate | None:
+    path = template_path(name)
+    properties_path = f"{path}/{PROPERTIES_NAME}"
+    if not os.path.exists(properties_path):
+        return None
+    try:
+        with open(f"{path}/{SCRIPT_NAME}", "r") as f:
+            script = f.read().strip()
+    except OSError:
+        script = ""
+    exit_code = _get_attr(properties_path, EXIT_CODE_ATTR)
+    return OverlayTemplate(
+        name=name,
+        image=_get_attr(properties_path, IMAGE_ATTR) or "",
+        image_digest=_get_attr(properties_path, IMAGE_DIGEST_ATTR) or "",
+        script=script,
+        state=_get_attr(properties_path, STATE_ATTR) or "not ready",
+        exit_code=int(exit_code) if exit_code is not None else None,
+    )
+
+
+def list_templates() -> list[OverlayTemplate]:
+    templates = []
+    for name in sorted(os.listdir(OVERLAYS_STORE)):
+        if not name.startswith("."):
+            template = get_template(name)
+            if template is not None:
+                templates.append(template)
+    return templates
+
+
+def template_key(name: str) -> str | None:
+    """
+    Get the hash of the image digest and setup script a ready template was
+    built from.
+    """
+    template = get_template(name)
+    if template is None or template.state != "ready":
+        return None
+    properties_path = f"{template_path(name)}/{PROPERTIES_NAME}"
+    script_hash = _get_attr(properties_path, HASH_ATTR) or ""
+    return hashlib.sha256(
+        f"{template.image_digest}\0{script_hash}".encode()
+    ).hexdigest()
+
+
+def define(name: str, definition: OverlayDefinition) -> bool:
+    """
+    Store the image and setup script of a template. Returns False when the
+    template is already built or building from the same image and script.
+    """
+    path = template_path(name)
+    properties_path = f"{path}/{PROPERTIES_NAME}"
+    script = "\n".join(definition.script).encode("utf-8")
+    script_hash = hashlib.sha256(script).hexdigest()
+    image_digest = image_store.get_digest(image_store.tag_path(definition.image))
+
+    template = get_template(name)
+    if (
+        template is not None
+        and template.state in ("building", "ready")
+        and template.image_digest == image_digest
+        and _get_attr(properties_path, HASH_ATTR) == script_hash
+    ):
+        return False
+    if name in _builds:
+        raise OverlayException("Overlay template is being built")
+
+    os.makedirs(path, exist_ok=True)
+    try:
+        digest = image_store.pin(definition.image, f"{path}/{IMAGE_NAME}")
+    except image_store.ImageException as e:
+        raise OverlayException(e.message)
+    with open(f"{path}/{SCRIPT_NAME}", "wb") as f:
+        f.write(script)
+    os.chmod(f"{path}/{SCRIPT_NAME}", 0o755)
+    if not os.path.exists(properties_path):
+        with open(properties_path, "w") as f:
+            f.write("SEE EXTENDED ATTRIBUTES\n")
+    _set_attr(properties_path, IMAGE_ATTR, definition.image)
+    _set_attr(properties_path, IMAGE_DIGEST_ATTR, digest)
+    _set_attr(properties_path, HASH_ATTR, script_hash)
+    _set_attr(properties_path, STATE_ATTR, "building")
+    try:
+        os.removexattr(properties_path, EXIT_CODE_ATTR, follow_symlinks=False)
+    except OSError:
+        pass
+    return True
+
+
+async def build(name: str) -> int:
+    """
+    Run the setup script of the template in a fresh overlay and replace the
+    template overlay with it if the script succeeds.
+    """
+    path = os.path.abspath(template_path(name))
+    properties_path = f"{path}/{PROPERTIES_NAME}"
+    tmp = f"{path}/.{OVERLAY_DIR}.{uuid.uuid4().hex}.tmp"
+    await pools.store.run(os.makedirs, tmp)
+    cmd = [
+        "apptainer",
+        "exec",
+        "-C",
+        "--fakeroot",
+        "--bind",
+        f"{path}/{SCRIPT_NAME}",
+        "--overlay",
+        tmp,
+        f"{path}/{IMAGE_NAME}",
+        f"{path}/{SCRIPT_NAME}",
+    ]
+    logger.info(f"Building overlay template {name} with command: {' '.join(cmd)}")
+    exit_code = -1
+    try:
+        log = await pools.store.run(joblog.LogWriter, f"{path}/{LOG_FILE}")
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+            )
+            while chunk := await process.stdout.read(joblog.CHUNK_SIZE):
+                await pools.store.run(log.write, chunk)
+            exit_code = await process.wait()
+        finally:
+            await pools.store.run(log.close)
+        if exit_code == 0:
+            await pools.store.run(_replace_overlay, path, tmp)
+    except Exception as e:
+        logger.error(f"Error building overlay template {name}: {e}")
+    finally:
+        try:
+            await pools.store.run(_finish_build, properties_path, tmp, exit_code)
+        finally:
+            _builds.pop(name, None)
+    logger.info(f"Overlay template {name} built with exit code: {exit_code}")
+    return exit_code
+
+
+def _replace_overlay(path: str, tmp: str):
+    old = f"{path}/.{OVERLAY_DIR}.{uuid.uuid4().hex}.old"
+    if os.path.exists(f"{path}/{OVERLAY_DIR}"):
+        os.rename(f"{path}/{OVERLAY_DIR}", old)
+    os.rename(tmp, f"{path}/{OVERLAY_DIR}")
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def _finish_build(properties_path: str, tmp: str, exit_code: int):
+    shutil.rmtree(tmp, ignore_errors=True)
+    _set_attr(properties_path, EXIT_CODE_ATTR, str(exit_code))
+    _set_attr(properties_path, STATE_ATTR, "ready" if exit_code == 0 else "failed")
+
+
+def start_build(name: str):
+    task = asyncio.create_task(build(name))
+    _builds[name] = task
+
+
+def delete(name: str):
+    path = template_path(name)
+    if not os.path.exists(path):
+        raise OverlayException("Overlay template not found")
+    if name in _builds:
+        raise OverlayException("Overlay template is being built")
+    shutil.rmtree(path)
+    image_store.gc()
+
+
+def snapshot(name: str, image_digest: str, dst: str):
+    """
+    Snapshot the template overlay to dst, which must not exist. The template
+    must be ready and built from the image the job runs.
+    """
+    template = get_template(name)
+    if template is None:
+        raise OverlayException(f"Overlay template '{name}' not found")
+    if template.state != "ready":
+        raise OverlayException(f"Overlay template '{name}' is {template.state}")
+    if template.image_digest != image_digest:
+        raise OverlayException(
+            f"Overlay template '{name}' was built from another image"
+        )
+    src = f"{template_path(name)}/{OVERLAY_DIR}"
+    # Hard links are a safe fallback: the snapshot is only mounted read-only.
+    tmp = f"{dst}.{uuid.uuid4().hex}.tmp"
+    try:
+        shutil.copytree(src, tmp, symlinks=True, copy_function=fs.clone)
+        os.rename(tmp, dst)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def recover():
+    """
+    Mark builds interrupted by a restart as failed and drop their leftovers.
+    """
+    for template in list_templates():
+        path = template_path(template.name)
+        for filename in os.listdir(path):
+            if filename.startswith(f".{OVERLAY_DIR}."):
+                shutil.rmtree(f"{path}/{filename}", ignore_errors=True)
+        if template.state == "building":
+            _set_attr(f"{path}/{PROPERTIES_NAME}", STATE_ATTR, "failed")
+
+
+recover()
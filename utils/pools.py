@@ -0,0 +1,106 @@
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Iterator, TypeVar
+
+from utils import metrics
+
+STORE_THREADS = int(os.environ.get("RES_STORE_THREADS", "16"))
+CPU_THREADS = int(os.environ.get("RES_CPU_THREADS", os.cpu_count() or 1))
+
+T = TypeVar("T")
+
+# Blocking work runs on one of two sized pools instead of the event loop:
+# store for filesystem and index operations, cpu for compression and hashing,
+# so a burst of archive builds cannot starve simple store reads.
+
+
+class Pool:
+    """
+    Thread pool awaited from the event loop, counting queued and running
+    calls for the metrics.
+    """
+
+    def __init__(self, name: str, size: int):
+        self.name = name
+        self.size = max(1, size)
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.size, thread_name_prefix=f"res-{name}"
+        )
+        self.queued = 0
+        self.active = 0
+        self.lock = threading.Lock()
+
+    async def run(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        """
+        Call fn in the pool, in the context of the caller.
+        """
+        context = contextvars.copy_context()
+        submitted = time.perf_counter()
+        state = {"started": False, "cancelled": False}
+        with self.lock:
+            self.queued += 1
+
+        def call():
+            with self.lock:
+                if state["cancelled"]:
+                    return None
+                state["started"] = True
+                self.queued -= 1
+                self.active += 1
+            metrics.pool_wait_seconds.observe(
+                time.perf_counter() - submitted, pool=self.name
+            )
+            try:
+                return context.run(fn, *args, **kwargs)
+            finally:
+                with self.lock:
+                    self.active -= 1
+
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self.executor, call)
+        except asyncio.CancelledError:
+            with self.lock:
+                if not state["started"]:
+                    state["cancelled"] = True
+                    self.queued -= 1
+            raise
+
+    async def iterate(self, iterator: Iterator[T]) -> AsyncIterator[T]:
+        """
+        Drive a blocking iterator in the pool, one item per call.
+        """
+        done = object()
+        while True:
+            item = await self.run(next, iterator, done)
+            if item is done:
+                return
+            yield item
+
+
+store = Pool("store", STORE_THREADS)
+cpu = Pool("cpu", CPU_THREADS)
+POOLS = (store, cpu)
+
+metrics.Gauge(
+    "res_pool_threads",
+    "Size of the I/O thread pools",
+    ("pool",),
+    callback=lambda: {(pool.name,): pool.size for pool in POOLS},
+)
+metrics.Gauge(
+    "res_pool_active",
+    "Calls running in the I/O thread pools",
+    ("pool",),
+    callback=lambda: {(pool.name,): pool.active for pool in POOLS},
+)
+metrics.Gauge(
+    "res_pool_queued",
+    "Calls waiting for a thread of the I/O thread pools",
+    ("pool",),
+    callback=lambda: {(pool.name,): pool.queued for pool in POOLS},
+)
@@ -0,0 +1,239 @@
+import asyncio
+import logging
+import os
+import shutil
+import time
+
+from pydantic import BaseModel, Field
+
+import utils.job as jobs
+from utils import fs, image as image_store, index, metrics, pools
+from utils.scheduler import scheduler
+
+logger = logging.getLogger("uvicorn.error")
+
+GC_INTERVAL = float(os.environ.get("RES_GC_INTERVAL", "3600"))
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 24 * 3600}
+
+# The reaper deletes finished jobs by policy: a maximum age per state, the
+# number of most recent jobs to keep and a byte quota of finished jobs,
+# evicted in least recently used order. Jobs that are queued or running,
+# jobs of unfinished pipelines and jobs whose artifacts are inputs of
+# unfinished jobs are never deleted. Deleting a job only unlinks its files,
+# so the files it shares with other jobs or images stay. Image blobs only
+# referenced by deleted jobs are removed at the end of a pass.
+
+
+def parse_duration(value: str) -> float:
+    """
+    Parse seconds, or a number with an s, m, h or d unit.
+    """
+    value = value.strip()
+    unit = DURATION_UNITS.get(value[-1:])
+    if unit is not None:
+        value = value[:-1]
+    try:
+        return float(value) * (unit or 1)
+    except ValueError:
+        raise ValueError(f"Invalid duration '{value}'")
+
+
+def parse_max_age(spec: str) -> dict[str, float]:
+    """
+    Parse maximum ages by state, e.g. "failed=7d,stopped=12h".
+    """
+    ages = {}
+    for item in filter(None, (item.strip() for item in spec.split(","))):
+        state, sep, duration = item.partition("=")
+        if not sep:
+            raise ValueError(f"Max age must be <state>=<duration>, not '{item}'")
+        state = state.strip()
+        if state in jobs.ACTIVE_STATES:
+            raise ValueError(f"Jobs in state '{state}' are never deleted")
+        ages[state] = parse_duration(duration)
+    return ages
+
+
+class Policy(BaseModel):
+    max_age: dict[str, float] = Field(default_factory=dict)
+    keep_last: int = Field(default=0, ge=0)
+    quota: int = Field(default=0, ge=0)
+
+
+POLICY = Policy(
+    max_age=parse_max_age(os.environ.get("RES_GC_MAX_AGE", "")),
+    keep_last=int(os.environ.get("RES_GC_KEEP_LAST", "0")),
+    quota=int(os.environ.get("RES_GC_QUOTA", "0")),
+)
+
+
+class ReapedJob(BaseModel):
+    id: int
+    state: str
+    reason: str
+    size: int
+
+
+class Report(BaseModel):
+    dry_run: bool
+    jobs: list[ReapedJob]
+    protected: list[int]
+    image_bytes: int
+    reclaimed_bytes: int
+
+
+def protected_jobs(rows: list[tuple]) -> set[int]:
+    """
+    Get the IDs of the jobs that unfinished jobs depend on: jobs of running
+    pipelines and upstream jobs of the inputs of unfinished jobs.
+    """
+    protected = index.active_pipeline_jobs(jobs.ACTIVE_STATES)
+    for job_id, state, *_ in rows:
+        if state not in jobs.TERMINAL_STATES:
+            protected.update(jobs.job_inputs(job_id).values())
+    return protected
+
+
+def _size(job_id: int) -> int:
+    return fs.freed_size(jobs.job_dir(job_id))
+
+
+def _image_size(job_ids: list[int]) -> int:
+    """
+    Get the bytes of the image blobs only referenced by the jobs.
+    """
+    links: dict[tuple[int, int], int] = {}
+    size = 0
+    for job_id in job_ids:
+        try:
+            st = os.stat(f"{jobs.job_dir(job_id)}/{jobs.IMAGE_NAME}")
+        except OSError:
+            continue
+        key = (st.st_dev, st.st_ino)
+        links[key] = links.get(key, 0) + 1
+        # The blob is the last link.
+        if links[key] == st.st_nlink - 1:
+            size += st.st_blocks * 512
+    return size
+
+
+def collect(
+    policy: Policy = POLICY, active: frozenset[int] = frozenset(), dry_run: bool = False
+) -> Report:
+    """
+    Delete the jobs selected by the policy, or only list them on a dry run.
+    active are the IDs of the jobs known to the scheduler.
+    """
+    now = time.time()
+    rows = index.query_retention()
+    protected = protected_jobs(rows)
+    candidates = [
+        row
+        for row in rows
+        if row[0] not in protected
+        and row[0] not in active
+        and row[1] not in jobs.ACTIVE_STATES
+    ]
+    finished = [row for row in candidates if row[1] in jobs.TERMINAL_STATES]
+    states = {row[0]: row[1] for row in candidates}
+    selected: dict[int, str] = {}
+
+    for job_id, state, changed, _, _ in candidates:
+        if state not in policy.max_age:
+            continue
+        if changed is None:
+            try:
+                changed = os.path.getmtime(jobs.job_dir(job_id))
+            except OSError:
+                continue
+        if now - changed > policy.max_age[state]:
+            selected[job_id] = "max_age"
+
+    if policy.keep_last:
+        for job_id, *_ in finished[: -policy.keep_last]:
+            selected.setdefault(job_id, "keep_last")
+
+    sizes = {row[0]: row[4] for row in finished if row[4] is not None}
+    if policy.quota:
+        measured = [(row[0], _size(row[0])) for row in finished if row[0] not in sizes]
+        index.set_job_sizes(measured)
+        sizes.update(measured)
+        total = sum(size for job_id, size in sizes.items() if job_id not in selected)
+        for job_id, *_ in sorted(finished, key=lambda row: row[3] or 0):
+            if total <= policy.quota:
+                break
+            if job_id not in selected:
+                selected[job_id] = "quota"
+                total -= sizes[job_id]
+
+    image_bytes = _image_size(list(selected)) if dry_run else 0
+    reaped = []
+    for job_id, reason in sorted(selected.items()):
+        if dry_run:
+            size = sizes.get(job_id)
+            if size is None:
+                size = _size(job_id)
+        else:
+            if jobs.job_state(job_id) in jobs.ACTIVE_STATES:
+                continue
+            try:
+                size = jobs.delete_job(job_id)
+            except (jobs.JobException, OSError) as e:
+                logger.error(f"Cannot delete job {job_id}: {e}")
+                continue
+            metrics.jobs_reaped.inc(reason=reason)
+            metrics.reclaimed_bytes.inc(size, reason=reason)
+        reaped.append(
+            ReapedJob(id=job_id, state=states[job_id], reason=reason, size=size)
+        )
+
+    if not dry_run and os.path.isdir(jobs.TRASH_STORE):
+        # Left over by deletions interrupted by a restart.
+        for name in os.listdir(jobs.TRASH_STORE):
+            shutil.rmtree(f"{jobs.TRASH_STORE}/{name}", ignore_errors=True)
+    if not dry_run:
+        image_bytes = sum(image_store.gc().values())
+        metrics.reclaimed_bytes.inc(image_bytes, reason="image")
+
+    return Report(
+        dry_run=dry_run,
+        jobs=reaped,
+        protected=sorted(protected),
+        image_bytes=image_bytes,
+        reclaimed_bytes=sum(job.size for job in reaped) + image_bytes,
+    )
+
+
+async def reap(policy: Policy = POLICY, dry_run: bool = False) -> Report:
+    active = frozenset(scheduler.running) | {entry.job_id for entry in scheduler.queue}
+    return await pools.store.run(collect, policy, active, dry_run)
+
+
+async def reap_periodically(interval: float = GC_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            report = await reap()
+        except Exception as e:
+            logger.error(f"Error collecting jobs: {e}")
+            continue
+        if report.jobs:
+            logger.info(
+                f"Deleted {len(report.jobs)} jobs, {report.reclaimed_bytes} bytes freed"
+            )
+
+
+_task: asyncio.Task | None = None
+
+
+def start():
+    global _task
+    if GC_INTERVAL > 0 and _task is None:
+        _task = asyncio.create_task(reap_periodically())
+
+
+def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        _task = None
@@ -0,0 +1,232 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+import utils.job as jobs
+from utils import build_cache, executor as executors, index, metrics, pools
+
+logger = logging.getLogger("uvicorn.error")
+
+MAX_CONCURRENT_JOBS = int(
+    os.environ.get("RES_MAX_CONCURRENT_JOBS", os.cpu_count() or 1)
+)
+CPU_BUDGET = float(os.environ.get("RES_CPU_BUDGET", "0"))
+MEMORY_BUDGET = int(os.environ.get("RES_MEMORY_BUDGET", "0"))
+DROP_OVERLAYS = os.environ.get("RES_GC_DROP_OVERLAYS", "1") != "0"
+
+Executor = Callable[[int], Awaitable[int]]
+
+
+@dataclass
+class QueuedJob:
+    job_id: int
+    cpus: float
+    memory: int
+    future: asyncio.Future = field(repr=False)
+    queued_at: float = field(default_factory=time.monotonic)
+
+
+class Scheduler:
+    """
+    FIFO queue of started jobs with a limit of concurrently running containers.
+
+    A CPU and memory (MiB) budget can be set to limit the sum of resources
+    requested by running jobs, 0 means no budget. The head of the queue always
+    starts when nothing is running, even if it asks for more than the budget.
+    """
+
+    def __init__(
+        self,
+        executor: Executor = executors.get_executor(),
+        max_concurrent: int = MAX_CONCURRENT_JOBS,
+        cpu_budget: float = CPU_BUDGET,
+        memory_budget: int = MEMORY_BUDGET,
+    ):
+        self.executor = executor
+        self.max_concurrent = max(1, max_concurrent)
+        self.cpu_budget = cpu_budget
+        self.memory_budget = memory_budget
+        self.queue: deque[QueuedJob] = deque()
+        self.running: dict[int, QueuedJob] = {}
+        self.tasks: dict[int, asyncio.Task] = {}
+        self.submitting: set[int] = set()
+
+    @property
+    def depth(self) -> int:
+        return len(self.queue)
+
+    def position(self, job_id: int) -> int | None:
+        """
+        Get the 1-based position of the job in the queue.
+        """
+        for i, entry in enumerate(self.queue):
+            if entry.job_id == job_id:
+                return i + 1
+        return None
+
+    def is_active(self, job_id: int) -> bool:
+        return (
+            job_id in self.running
+            or job_id in self.submitting
+            or self.position(job_id) is not None
+        )
+
+    @staticmethod
+    def _queue(job_id: int) -> tuple[float | None, int | None]:
+        cpus, memory = jobs.job_resources(job_id)
+        jobs.discard_manifest(job_id)
+        jobs.set_state(job_id, "queued")
+        index.job_queued(job_id)
+        return cpus, memory
+
+    async def submit(self, job_id: int) -> asyncio.Future:
+        """
+        Queue the job and return a future resolved with its exit code.
+        """
+        if self.is_active(job_id):
+            raise jobs.JobException("Job is already queued or running")
+        self.submitting.add(job_id)
+        try:
+            cpus, memory = await pools.store.run(self._queue, job_id)
+        finally:
+            self.submitting.discard(job_id)
+        future = asyncio.get_running_loop().create_future()
+        self.queue.append(QueuedJob(job_id, cpus or 0, memory or 0, future))
+        self._dispatch()
+        return future
+
+    def cancel(self, job_id: int) -> bool:
+        """
+        Remove a queued job from the queue. Running jobs are not affected.
+        """
+        for entry in self.queue:
+            if entry.job_id == job_id:
+                self.queue.remove(entry)
+                if not entry.future.done():
+                    entry.future.set_result(-1)
+                return True
+        return False
+
+    async def stop(self, job_id: int) -> bool:
+        """
+        Remove a queued job from the queue, or kill a running job and wait for
+        its task to end.
+        """
+        if self.cancel(job_id):
+            return True
+        task = self.tasks.get(job_id)
+        if task is None:
+            return False
+        task.cancel()
+        await asyncio.wait([task])
+        return True
+
+    def _fits(self, entry: QueuedJob) -> bool:
+        if not self.running:
+            return True
+        if len(self.running) >= self.max_concurrent:
+            return False
+        cpus = sum(job.cpus for job in self.running.values()) + entry.cpus
+        memory = sum(job.memory for job in self.running.values()) + entry.memory
+        if self.cpu_budget and cpus > self.cpu_budget:
+            return False
+        if self.memory_budget and memory > self.memory_budget:
+            return False
+        return True
+
+    def _dispatch(self):
+        while self.queue and self._fits(self.queue[0]):
+            entry = self.queue.popleft()
+            self.running[entry.job_id] = entry
+            self.tasks[entry.job_id] = asyncio.create_task(self._run(entry))
+
+    async def _write_manifest(self, job_id: int):
+        """
+        Store the artifact manifest of a finished job, if it has artifacts.
+        """
+        try:
+            await pools.cpu.run(jobs.write_manifest, job_id)
+        except jobs.JobException:
+            pass
+        except OSError as e:
+            logger.error(f"Cannot write artifact manifest of job {job_id}: {e}")
+
+    async def _run(self, entry: QueuedJob):
+        exit_code = -1
+        result = "failure"
+        started_at = time.monotonic()
+        metrics.job_queue_seconds.observe(started_at - entry.queued_at)
+        try:
+            await pools.store.run(jobs.set_state, entry.job_id, "running")
+            await pools.store.run(index.job_started, entry.job_id)
+            key = await pools.cpu.run(build_cache.job_key, entry.job_id)
+            if key is not None and await pools.store.run(
+                build_cache.restore, key, entry.job_id
+            ):
+                exit_code = 0
+                result = "cached"
+                await self._write_manifest(entry.job_id)
+                await pools.store.run(jobs.set_state, entry.job_id, jobs.CACHED_STATE)
+                return
+            exit_code = await self.executor(entry.job_id)
+            result = "success" if exit_code == 0 else "failure"
+            await self._write_manifest(entry.job_id)
+            if await pools.store.run(jobs.job_state, entry.job_id) == "running":
+                await pools.store.run(jobs.set_state, entry.job_id, "done")
+            if key is not None and exit_code == 0:
+                await pools.store.run(build_cache.save, key, entry.job_id)
+            if DROP_OVERLAYS:
+                freed = await pools.store.run(jobs.drop_overlay, entry.job_id)
+                metrics.reclaimed_bytes.inc(freed, reason="overlay")
+        except asyncio.CancelledError:
+            result = "stopped"
+            raise
+        except Exception as e:
+            logger.error(f"Error running job {entry.job_id}: {e}")
+            try:
+                await pools.store.run(jobs.set_state, entry.job_id, "failed")
+            except jobs.JobException:
+                pass
+        finally:
+            try:
+                await pools.store.run(index.job_finished, entry.job_id, exit_code)
+            except Exception as e:
+                logger.error(f"Cannot index the end of job {entry.job_id}: {e}")
+            metrics.jobs_completed.inc(result=result)
+            metrics.job_duration_seconds.observe(
+                time.monotonic() - started_at, result=result
+            )
+            del self.running[entry.job_id]
+            del self.tasks[entry.job_id]
+            if not entry.future.done():
+                entry.future.set_result(exit_code)
+            self._dispatch()
+
+
+def recover() -> list[int]:
+    """
+    Mark the jobs left queued or running by a restart as failed. Called at
+    startup, before any job is submitted.
+    """
+    recovered = []
+    for job_id in index.jobs_in_states(jobs.ACTIVE_STATES):
+        try:
+            if jobs.job_state(job_id) not in jobs.ACTIVE_STATES:
+                continue
+            jobs.set_exit_code(job_id, -1)
+            jobs.set_state(job_id, "failed")
+        except (jobs.JobException, OSError) as e:
+            logger.error(f"Cannot recover job {job_id}: {e}")
+            continue
+        index.job_finished(job_id, -1)
+        recovered.append(job_id)
+    if recovered:
+        logger.info(f"Marked {len(recovered)} jobs interrupted by a restart as failed")
+    return recovered
+
+
+scheduler = Scheduler()
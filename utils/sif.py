@@ -0,0 +1,136 @@
+import json
+import struct
+import uuid
+
+MAGIC = b"SIF_MAGIC\0"
+HEADER = struct.Struct("<32s10s3s3s16s8q")
+DESCRIPTOR = struct.Struct("<i?IIIqqqqqqq128s384s")
+PARTITION = struct.Struct("<ii3s")
+MAX_DESCRIPTORS = 4096
+MAX_JSON_SIZE = 1024**2
+
+DATA_LABELS = 0x4003
+DATA_PARTITION = 0x4004
+DATA_GENERIC_JSON = 0x4006
+
+ARCHITECTURES = {
+    "01": "386",
+    "02": "amd64",
+    "03": "arm",
+    "04": "arm64",
+    "05": "ppc64",
+    "06": "ppc64le",
+    "07": "mips",
+    "08": "mipsle",
+    "09": "mips64",
+    "10": "mips64le",
+    "11": "s390x",
+    "12": "riscv64",
+}
+FS_TYPES = {
+    1: "squashfs",
+    2: "ext3",
+    3: "immutable-object",
+    4: "raw",
+    5: "encrypted-squashfs",
+}
+PARTITION_TYPES = {1: "system", 2: "primary", 3: "data", 4: "overlay"}
+
+# A SIF file starts with a fixed size little endian header pointing to an
+# array of descriptors, one per object of the file (partitions, definition
+# file, labels, signatures...). Only the header, the descriptors and the
+# small JSON objects are read, whatever the size of the partitions.
+
+
+def _string(data: bytes) -> str:
+    return data.split(b"\0", 1)[0].decode(errors="replace")
+
+
+def _architecture(code: bytes) -> str | None:
+    return ARCHITECTURES.get(_string(code))
+
+
+def _read_json(f, offset: int, size: int) -> dict:
+    if size > MAX_JSON_SIZE:
+        return {}
+    f.seek(offset)
+    try:
+        value = json.loads(f.read(size))
+    except ValueError:
+        return {}
+    return value if isinstance(value, dict) else {}
+
+
+def read_metadata(path: str) -> dict | None:
+    """
+    Get the architecture, partitions and build labels of a SIF file, or None
+    when the file is not a SIF file. Raises ValueError when the header or the
+    descriptors are truncated.
+    """
+    with open(path, "rb") as f:
+        data = f.read(HEADER.size)
+        if len(data) < HEADER.size or data[32:42] != MAGIC:
+            return None
+        (
+            _,
+            _,
+            version,
+            arch,
+            id,
+            created_at,
+            modified_at,
+            _,
+            total,
+            descriptors_offset,
+            _,
+            _,
+            _,
+        ) = HEADER.unpack(data)
+        if not 0 <= total <= MAX_DESCRIPTORS:
+            raise ValueError(f"Invalid SIF descriptor count {total}")
+        f.seek(descriptors_offset)
+        data = f.read(total * DESCRIPTOR.size)
+        if len(data) < total * DESCRIPTOR.size:
+            raise ValueError("Truncated SIF descriptors")
+
+        partitions = []
+        labels = {}
+        for fields in DESCRIPTOR.iter_unpack(data):
+            type, used, _, _, _, offset, size, _, _, _, _, _, name, extra = fields
+            if not used:
+                continue
+            if type == DATA_PARTITION:
+                fs, part, part_arch = PARTITION.unpack_from(extra)
+                partitions.append(
+                    {
+                        "name": _string(name),
+                        "type": PARTITION_TYPES.get(part, str(part)),
+                        "fs": FS_TYPES.get(fs, str(fs)),
+                        "architecture": _architecture(part_arch),
+                        "size": size,
+                    }
+                )
+            elif type == DATA_LABELS:
+                labels.update(_read_json(f, offset, size))
+            elif type == DATA_GENERIC_JSON:
+                # Metadata of `apptainer inspect`, with the labels in its
+                # attributes.
+                value = _read_json(f, offset, size)
+                for key in ("data", "attributes", "labels"):
+                    value = value.get(key) if isinstance(value, dict) else None
+                if isinstance(value, dict):
+                    labels.update(value)
+
+    architecture = _architecture(arch)
+    if architecture is None:
+        primary = [p for p in partitions if p["type"] == "primary"]
+        architecture = primary[0]["architecture"] if primary else None
+    return {
+        "id": str(uuid.UUID(bytes=id)),
+        "version": _string(version),
+        "architecture": architecture,
+        "created_at": created_at,
+        "modified_at": modified_at,
+        "partitions": partitions,
+        "labels": {str(k): str(v) for k, v in labels.items()},
+    }